@@ -0,0 +1,87 @@
+"""Client-disconnect propagation helpers shared by the load balancer and server.py.
+
+When a student hits cancel in the UI the browser drops the connection. We want the
+upstream request (balancer -> server.py -> Ollama) to be closed right away, because
+closing the HTTP connection is what makes Ollama stop generating and free the slot.
+
+- Streaming endpoints: Starlette cancels the response generator on disconnect, so the
+  generator only has to clean up without awaiting anything cancellable.
+- Non-streaming endpoints: nobody watches the client while we wait for upstream, so
+  `call_unless_disconnected` polls `request.is_disconnected()` and cancels the call.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from fastapi import Request
+
+DISCONNECT_POLL_INTERVAL = 0.25
+
+# nginx's "client closed request"; nobody receives it, but it shows up in access logs
+CLIENT_CLOSED_REQUEST = 499
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def call_unless_disconnected(request: Request, aw: Awaitable, poll_interval: float = DISCONNECT_POLL_INTERVAL,
+                                   cleanup: Optional[Callable[[Any], Awaitable]] = None) -> Any:
+    """Await `aw`, cancelling it (and closing its connection) if the client goes away first.
+
+    The cancel can lose the race: `aw` may already have produced its result (e.g. a
+    backend slot handed over just before). That result is passed to `cleanup`.
+    """
+    task = asyncio.ensure_future(aw)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                await asyncio.wait({task})  # let httpx close the upstream connection
+                if cleanup is not None and not task.cancelled() and task.exception() is None:
+                    await cleanup(task.result())
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+class CancelStats:
+    """Counts cancelled requests and estimates the generation time that cancelling saved.
+
+    The saving is estimated as the average duration of completed requests on the same
+    endpoint minus how long the cancelled one had already been running.
+    """
+
+    def __init__(self):
+        self.completed: Dict[str, int] = {}
+        self.avg_duration: Dict[str, float] = {}
+        self.cancelled: Dict[str, Dict[str, int]] = {}
+        self.busy_seconds = 0.0
+        self.avoided_seconds = 0.0
+
+    def record_completed(self, endpoint: str, duration: float):
+        self.completed[endpoint] = self.completed.get(endpoint, 0) + 1
+        prev = self.avg_duration.get(endpoint)
+        self.avg_duration[endpoint] = duration if prev is None else 0.9 * prev + 0.1 * duration
+
+    def record_cancelled(self, endpoint: str, phase: str, elapsed: float):
+        """`phase` is where the client left: queued, upstream (waiting on a non-streaming
+        reply), prefill (before the first token) or streaming."""
+        by_phase = self.cancelled.setdefault(endpoint, {})
+        by_phase[phase] = by_phase.get(phase, 0) + 1
+        self.busy_seconds += elapsed
+        self.avoided_seconds += max(0.0, self.avg_duration.get(endpoint, 0.0) - elapsed)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'completed': dict(self.completed),
+            'cancelled': {k: dict(v) for k, v in self.cancelled.items()},
+            'cancelled_total': sum(sum(v.values()) for v in self.cancelled.values()),
+            'avg_completed_seconds': {k: round(v, 3) for k, v in self.avg_duration.items()},
+            'busy_seconds_before_cancel': round(self.busy_seconds, 3),
+            'wasted_generation_seconds_avoided': round(self.avoided_seconds, 3),
+        }
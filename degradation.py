@@ -0,0 +1,168 @@
+"""Graceful degradation for the load balancer when the fleet is saturated.
+
+The controller watches fleet utilisation (busy slots / routable slots) and the depth
+of the scheduling queue, and moves between three levels:
+
+  0 normal    every request is served as asked
+  1 degraded  eligible requests are rerouted to DEGRADED_MODEL (a smaller or more
+              heavily quantised model) and num_predict is capped
+  2 shedding  as degraded, and requests whose priority is in SHED_PRIORITIES get
+              a fast 503 instead of joining the queue
+
+Escalation is immediate. De-escalation goes one level at a time, only after the
+level has been held for DEGRADE_MIN_DWELL seconds and the signals are below the
+(lower) exit thresholds, so the fleet does not flap between modes.
+
+Priority is decided here, not by the client: "high" (never degraded or shed) is
+only given to HIGH_PRIORITY_IPS or to requests carrying one of HIGH_PRIORITY_TOKENS.
+Everyone else is "normal", unless they ask to be "low" with X-Priority.
+"""
+
+import hmac, ipaddress, os, time
+from typing import Any, Dict, Optional
+
+# a client may only lower its own priority: "X-Priority: low"
+PRIORITY_HEADER = "X-Priority"
+# admin-issued secret that grants "high"
+PRIORITY_TOKEN_HEADER = "X-Priority-Token"
+# on every response: "true", "false" or "shed"; X-Served-Model names the model actually used
+DEGRADED_HEADER = "X-Degraded"
+SERVED_MODEL_HEADER = "X-Served-Model"
+
+DEGRADED_MODEL = os.getenv("DEGRADED_MODEL", "")  # e.g. "llama3.2:3b"; empty = only cap num_predict
+DEGRADED_NUM_PREDICT = int(os.getenv("DEGRADED_NUM_PREDICT", "256"))
+SHED_PRIORITIES = {p.strip() for p in os.getenv("SHED_PRIORITIES", "low,normal").split(",") if p.strip()}
+# comma separated addresses or networks, e.g. "10.47.0.1,10.100.0.0/16"
+HIGH_PRIORITY_NETWORKS = [ipaddress.ip_network(n.strip(), strict=False)
+                          for n in os.getenv("HIGH_PRIORITY_IPS", "").split(",") if n.strip()]
+HIGH_PRIORITY_TOKENS = [t.strip() for t in os.getenv("HIGH_PRIORITY_TOKENS", "").split(",") if t.strip()]
+SHED_RETRY_AFTER = int(os.getenv("SHED_RETRY_AFTER", "30"))
+
+DEGRADE_ENTER_UTIL = float(os.getenv("DEGRADE_ENTER_UTIL", "0.9"))
+DEGRADE_EXIT_UTIL = float(os.getenv("DEGRADE_EXIT_UTIL", "0.7"))
+DEGRADE_ENTER_QUEUE = int(os.getenv("DEGRADE_ENTER_QUEUE", "4"))
+DEGRADE_EXIT_QUEUE = int(os.getenv("DEGRADE_EXIT_QUEUE", "0"))
+SHED_ENTER_QUEUE = int(os.getenv("SHED_ENTER_QUEUE", "20"))
+SHED_EXIT_QUEUE = int(os.getenv("SHED_EXIT_QUEUE", "5"))
+DEGRADE_MIN_DWELL = float(os.getenv("DEGRADE_MIN_DWELL", "30"))
+
+LEVEL_NAMES = ("normal", "degraded", "shedding")
+
+
+def resolve_priority(client_ip: str, token: Optional[str], requested: Optional[str]) -> str:
+    """Server-side priority of a request; a client-sent "high" is ignored."""
+    if token and any(hmac.compare_digest(token, t) for t in HIGH_PRIORITY_TOKENS):
+        return "high"
+    if HIGH_PRIORITY_NETWORKS:
+        try:
+            addr = ipaddress.ip_address(client_ip)
+        except ValueError:
+            addr = None
+        if addr is not None and any(addr in net for net in HIGH_PRIORITY_NETWORKS):
+            return "high"
+    return "low" if isinstance(requested, str) and requested.lower() == "low" else "normal"
+
+
+class Decision:
+    """What the controller did to one request."""
+    __slots__ = ("level", "shed", "degraded", "model", "num_predict")
+
+    def __init__(self, level: int, model: Optional[str]):
+        self.level = level
+        self.shed = False
+        self.degraded = False
+        self.model = model
+        self.num_predict: Optional[int] = None
+
+    def headers(self) -> Dict[str, str]:
+        if self.shed:
+            return {DEGRADED_HEADER: "shed", "Retry-After": str(SHED_RETRY_AFTER)}
+        h = {DEGRADED_HEADER: "true" if self.degraded else "false"}
+        if self.model:
+            h[SERVED_MODEL_HEADER] = self.model
+        return h
+
+
+class DegradationController:
+    def __init__(self):
+        self.level = 0
+        self.changed_at = time.monotonic()
+        self.utilisation = 0.0
+        self.queue_depth = 0
+        self.time_in_level = [0.0, 0.0, 0.0]
+        self.transitions = 0
+        self.requests = 0
+        self.rerouted = 0
+        self.capped = 0
+        self.shed: Dict[str, int] = {}
+
+    def _set_level(self, level: int, now: float):
+        self.time_in_level[self.level] += now - self.changed_at
+        print(f"[degrade] {LEVEL_NAMES[self.level]} -> {LEVEL_NAMES[level]} "
+              f"(utilisation {self.utilisation:.2f}, queue {self.queue_depth})")
+        self.level = level
+        self.changed_at = now
+        self.transitions += 1
+
+    def update(self, utilisation: float, queue_depth: int) -> int:
+        self.utilisation = utilisation
+        self.queue_depth = queue_depth
+        now = time.monotonic()
+        if queue_depth >= SHED_ENTER_QUEUE:
+            wanted = 2
+        elif utilisation >= DEGRADE_ENTER_UTIL or queue_depth >= DEGRADE_ENTER_QUEUE:
+            wanted = 1
+        else:
+            wanted = 0
+        if wanted > self.level:
+            self._set_level(wanted, now)
+        elif self.level > 0 and now - self.changed_at >= DEGRADE_MIN_DWELL:
+            if self.level == 2 and queue_depth < SHED_EXIT_QUEUE:
+                self._set_level(1, now)
+            elif self.level == 1 and utilisation < DEGRADE_EXIT_UTIL and queue_depth <= DEGRADE_EXIT_QUEUE:
+                self._set_level(0, now)
+        return self.level
+
+    def admit(self, payload: Dict[str, Any], priority: str) -> Decision:
+        """Apply the current level to one request's payload (in place). `priority` comes from resolve_priority."""
+        self.requests += 1
+        decision = Decision(self.level, payload.get("model"))
+        if self.level == 0 or priority == "high":
+            return decision
+        if self.level >= 2 and priority in SHED_PRIORITIES:
+            decision.shed = True
+            self.shed[priority] = self.shed.get(priority, 0) + 1
+            return decision
+
+        decision.degraded = True
+        if DEGRADED_MODEL and payload.get("model") != DEGRADED_MODEL:
+            payload["model"] = decision.model = DEGRADED_MODEL
+            self.rerouted += 1
+        options = payload.get("options")
+        if not isinstance(options, dict):
+            options = payload["options"] = {}
+        current = options.get("num_predict")
+        if not isinstance(current, int) or current < 0 or current > DEGRADED_NUM_PREDICT:
+            options["num_predict"] = DEGRADED_NUM_PREDICT
+            self.capped += 1
+        decision.num_predict = options["num_predict"]
+        return decision
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        time_in_level = list(self.time_in_level)
+        time_in_level[self.level] += now - self.changed_at
+        return {
+            'level': LEVEL_NAMES[self.level],
+            'since_seconds': round(now - self.changed_at, 1),
+            'utilisation': round(self.utilisation, 3),
+            'queue_depth': self.queue_depth,
+            'transitions': self.transitions,
+            'seconds_in_level': {LEVEL_NAMES[i]: round(t, 1) for i, t in enumerate(time_in_level)},
+            'requests': self.requests,
+            'rerouted': self.rerouted,
+            'capped': self.capped,
+            'shed': dict(self.shed),
+            'shed_total': sum(self.shed.values()),
+            'degraded_model': DEGRADED_MODEL or None,
+        }
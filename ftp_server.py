@@ -1,25 +1,344 @@
 # file_browser.py
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from pathlib import Path
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from email.utils import formatdate
+from typing import Dict, Optional, Tuple
 import urllib.parse
 import mimetypes
+import asyncio, mmap, os, time
 
 ROOT = Path("./srv/public_files").resolve()  # <-- change to your folder
 
-app = FastAPI(title="Public File Browser")
+# Bandwidth shaping (bytes/second, 0 = unlimited). The global rate should be a bit
+# below the real uplink so the shaper, not the switch, decides who waits.
+GLOBAL_RATE = float(os.getenv("FTP_GLOBAL_RATE", str(100 * 1024 * 1024)))
+CLIENT_RATE = float(os.getenv("FTP_CLIENT_RATE", str(20 * 1024 * 1024)))
+CHUNK_SIZE = int(os.getenv("FTP_CHUNK_SIZE", str(256 * 1024)))
+
+# Hot-file cache: files requested at least HOT_MIN_HITS times are kept mmapped
+# (up to HOT_CACHE_BYTES in total) so concurrent readers share the same pages.
+# Replace published files by writing a new file and renaming it over the old one:
+# open maps keep the old inode. Rewriting a file in place (cp over it) is detected
+# before every chunk and ends those downloads, but a truncation in the gap between
+# that check and the copy would still SIGBUS the server.
+HOT_CACHE_BYTES = int(os.getenv("FTP_HOT_CACHE_BYTES", str(8 * 1024 ** 3)))
+HOT_MIN_HITS = int(os.getenv("FTP_HOT_MIN_HITS", "2"))
 
-# Optional: mount a /raw path to serve static files efficiently
-app.mount("/raw", StaticFiles(directory=str(ROOT), html=False), name="raw")
+# per-client/per-file stats and hit counts unused for this long are dropped
+STATS_IDLE_SECONDS = float(os.getenv("FTP_STATS_IDLE_SECONDS", "600"))
+PRUNE_INTERVAL = 60.0
+
+app = FastAPI(title="Public File Browser")
 
 def safe_join(root: Path, rel: str) -> Path:
     # Avoid path traversal
     target = (root / rel).resolve()
-    if not str(target).startswith(str(root)):
+    # a prefix check would let "../public_files_secret" through
+    if not target.is_relative_to(root):
         raise HTTPException(403, "Forbidden")
     return target
 
+class TokenBucket:
+    """Async token bucket. Waiters queue on the lock, so chunks are granted FIFO."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate / 4, CHUNK_SIZE * 4)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def consume(self, n: int):
+        if self.rate <= 0:
+            return
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # go into debt and sleep it off, so chunks larger than the burst still pass
+            self.tokens -= n
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / self.rate)
+
+
+class Meter:
+    """Byte counter with a smoothed bytes/second rate."""
+
+    def __init__(self):
+        self.bytes_total = 0
+        self.requests = 0
+        self.active = 0
+        self.rate = 0.0
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self.last_seen = self._window_start
+
+    def add(self, n: int):
+        self.bytes_total += n
+        self._window_bytes += n
+        now = time.monotonic()
+        self.last_seen = now
+        elapsed = now - self._window_start
+        if elapsed >= 1.0:
+            inst = self._window_bytes / elapsed
+            self.rate = inst if self.rate == 0 else 0.7 * self.rate + 0.3 * inst
+            self._window_start = now
+            self._window_bytes = 0
+
+    def snapshot(self) -> dict:
+        # a meter that has not seen bytes for a while is idle, not frozen at its last rate
+        idle = time.monotonic() - self._window_start > 5.0
+        return {
+            'bytes_total': self.bytes_total,
+            'requests': self.requests,
+            'active': self.active,
+            'bytes_per_sec': 0.0 if idle else round(self.rate, 1),
+        }
+
+
+class DownloadScheduler:
+    """Global + per-client token buckets with an equal share of the global rate per active client."""
+
+    def __init__(self, global_rate: float, client_rate: float):
+        self.global_bucket = TokenBucket(global_rate)
+        self.client_rate = client_rate
+        self.client_buckets: Dict[str, TokenBucket] = {}
+        self.client_stats: Dict[str, Meter] = {}
+        self.file_stats: Dict[str, Meter] = {}
+        self.total = Meter()
+        self.active_clients = 0
+
+    def fair_rate(self) -> float:
+        rates = [self.client_rate]
+        if self.global_bucket.rate > 0:
+            rates.append(self.global_bucket.rate / max(1, self.active_clients))
+        rates = [r for r in rates if r > 0]
+        return min(rates) if rates else 0
+
+    @asynccontextmanager
+    async def session(self, client: str, file_key: str):
+        cstats = self.client_stats.setdefault(client, Meter())
+        fstats = self.file_stats.setdefault(file_key, Meter())
+        cstats.last_seen = fstats.last_seen = time.monotonic()
+        if cstats.active == 0:
+            self.active_clients += 1
+            self.client_buckets[client] = TokenBucket(self.fair_rate())
+        for m in (cstats, fstats, self.total):
+            m.active += 1
+            m.requests += 1
+        try:
+            yield
+        finally:
+            for m in (cstats, fstats, self.total):
+                m.active -= 1
+            if cstats.active == 0:
+                self.active_clients -= 1
+                self.client_buckets.pop(client, None)
+
+    async def throttle(self, client: str, file_key: str, n: int):
+        bucket = self.client_buckets[client]
+        bucket.rate = self.fair_rate()
+        await bucket.consume(n)
+        await self.global_bucket.consume(n)
+        self.client_stats[client].add(n)
+        self.file_stats[file_key].add(n)
+        self.total.add(n)
+
+    def prune(self, idle: float):
+        """Forget clients and files with no active download that have been idle for `idle` seconds."""
+        cutoff = time.monotonic() - idle
+        for table in (self.client_stats, self.file_stats):
+            for key in [k for k, m in table.items() if m.active == 0 and m.last_seen < cutoff]:
+                del table[key]
+
+    def stats(self) -> dict:
+        return {
+            'global_rate': self.global_bucket.rate,
+            'client_rate': self.client_rate,
+            'fair_rate': self.fair_rate(),
+            'active_clients': self.active_clients,
+            'total': self.total.snapshot(),
+            'files': {k: m.snapshot() for k, m in self.file_stats.items()},
+            'clients': {k: m.snapshot() for k, m in self.client_stats.items()},
+        }
+
+
+class HotFileCache:
+    """Read-only mmaps of the most requested files, evicted LRU by total size.
+
+    Evicted maps are only dropped from the index; readers still holding one keep
+    it alive and it is unmapped when the last of them finishes.
+    """
+
+    def __init__(self, max_bytes: int, min_hits: int):
+        self.max_bytes = max_bytes
+        self.min_hits = min_hits
+        self.entries: "OrderedDict[str, Tuple[int, int, mmap.mmap]]" = OrderedDict()
+        self.hits: Dict[str, int] = {}
+        self.last_hit: Dict[str, float] = {}
+        self.size = 0
+
+    def _evict(self, key: str):
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+    def get(self, path: Path, st: os.stat_result) -> Optional[mmap.mmap]:
+        key = str(path)
+        self.hits[key] = self.hits.get(key, 0) + 1
+        self.last_hit[key] = time.monotonic()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                self.entries.move_to_end(key)
+                return entry[2]
+            self._evict(key)  # file changed on disk
+        if self.hits[key] < self.min_hits or st.st_size == 0 or st.st_size > self.max_bytes:
+            return None
+        while self.entries and self.size + st.st_size > self.max_bytes:
+            self._evict(next(iter(self.entries)))
+        try:
+            with open(path, "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        self.entries[key] = (st.st_mtime_ns, st.st_size, m)
+        self.size += st.st_size
+        return m
+
+    def prune(self, idle: float):
+        """Drop hit counts of uncached files nobody asked for in `idle` seconds."""
+        cutoff = time.monotonic() - idle
+        for key in [k for k, t in self.last_hit.items() if t < cutoff and k not in self.entries]:
+            del self.hits[key], self.last_hit[key]
+
+    def stats(self) -> dict:
+        return {
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'files': [str(Path(k).relative_to(ROOT)) for k in self.entries],
+        }
+
+
+scheduler = DownloadScheduler(GLOBAL_RATE, CLIENT_RATE)
+hot_cache = HotFileCache(HOT_CACHE_BYTES, HOT_MIN_HITS)
+last_prune = time.monotonic()
+
+
+def maybe_prune():
+    global last_prune
+    now = time.monotonic()
+    if now - last_prune >= PRUNE_INTERVAL:
+        last_prune = now
+        scheduler.prune(STATS_IDLE_SECONDS)
+        hot_cache.prune(STATS_IDLE_SECONDS)
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single "bytes=" range into inclusive (start, end).
+
+    Returns None when the whole file should be sent (no header, or a multi-range
+    request, which we are allowed to ignore). Raises 416 if unsatisfiable.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if first == "":
+            # suffix range: the last N bytes
+            n = int(last)
+            if n <= 0:
+                raise ValueError
+            start, end = max(0, size - n), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                return None  # syntactically invalid: ignored, the whole file is sent (RFC 9110 14.2)
+    except ValueError:
+        return None
+    end = min(end, size - 1)
+    if start >= size:
+        raise HTTPException(416, "Requested range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+def read_chunk(fd: int, hot: Optional[mmap.mmap], pos: int, n: int, expected: Tuple[int, int, int]) -> bytes:
+    """Read one chunk, refusing if the open file is no longer the one whose headers were sent."""
+    st = os.fstat(fd)
+    if (st.st_ino, st.st_mtime_ns, st.st_size) != expected:
+        # rewritten in place: touching the old map past a truncation would SIGBUS
+        raise OSError(f"file changed during download (fd {fd})")
+    if hot is not None:
+        # slicing copies, and faults pages in from disk if they are not resident
+        return hot[pos:pos + n]
+    return os.pread(fd, n, pos)
+
+
+async def file_chunks(path: Path, file_key: str, client: str, start: int, end: int,
+                      hot: Optional[mmap.mmap], st: os.stat_result):
+    expected = (st.st_ino, st.st_mtime_ns, st.st_size)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        async with scheduler.session(client, file_key):
+            pos = start
+            while pos <= end:
+                n = min(CHUNK_SIZE, end - pos + 1)
+                await scheduler.throttle(client, file_key, n)
+                data = await asyncio.to_thread(read_chunk, fd, hot, pos, n, expected)
+                if not data:
+                    break
+                pos += len(data)
+                yield data
+    finally:
+        os.close(fd)
+
+
+async def serve_file(request: Request, target: Path, rel_path: str, attachment: bool = False):
+    """Serve a file through the download scheduler, honouring Range/If-Range."""
+    st = target.stat()
+    size = st.st_size
+    etag = f'"{st.st_mtime_ns:x}-{size:x}"'
+    last_modified = formatdate(st.st_mtime, usegmt=True)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": last_modified,
+    }
+    if attachment:
+        headers["Content-Disposition"] = f"attachment; filename*=utf-8''{urllib.parse.quote(target.name)}"
+    media_type = mimetypes.guess_type(target.name)[0] or "application/octet-stream"
+
+    byte_range = None
+    if_range = request.headers.get("if-range")
+    # a resumed download only gets the partial body if the file has not changed since
+    if size > 0 and (if_range is None or if_range in (etag, last_modified)):
+        byte_range = parse_range(request.headers.get("range"), size)
+
+    if byte_range is None:
+        start, end, status = 0, size - 1, 200
+    else:
+        start, end = byte_range
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+
+    if request.method == "HEAD" or size == 0:
+        return Response(status_code=status, headers=headers, media_type=media_type)
+
+    client = request.client.host if request.client else "unknown"
+    maybe_prune()
+    hot = hot_cache.get(target, st)
+    return StreamingResponse(
+        file_chunks(target, rel_path, client, start, end, hot, st),
+        status_code=status,
+        headers=headers,
+        media_type=media_type,
+    )
+
+
 def icon(name: str, is_dir: bool) -> str:
     return "📁" if is_dir else "📄"
 
@@ -49,18 +368,32 @@ async def root():
     return ('<meta http-equiv="refresh" content="0; url=/browse/">'
             '<a href="/browse/">Open file browser</a>')
 
+@app.api_route("/raw/{rel_path:path}", methods=["GET", "HEAD"])
+async def raw(request: Request, rel_path: str):
+    target = safe_join(ROOT, rel_path)
+    if not target.is_file():
+        raise HTTPException(404, "Not found")
+    return await serve_file(request, target, rel_path)
+
+
+@app.get("/stats")
+async def stats():
+    """Per-file and per-client throughput of the download scheduler."""
+    out = scheduler.stats()
+    out['hot_cache'] = hot_cache.stats()
+    return JSONResponse(out)
+
+
 @app.get("/browse/", response_class=HTMLResponse)
 @app.get("/browse/{rel_path:path}", response_class=HTMLResponse)
-async def browse(rel_path: str = ""):
+async def browse(request: Request, rel_path: str = ""):
     target = safe_join(ROOT, rel_path)
     if not target.exists():
         raise HTTPException(404, "Not found")
 
-    # If it's a file, serve it directly
+    # If it's a file, serve it through the same scheduler as /raw
     if target.is_file():
-        # Use /raw for efficient static serving (supports range, proper headers)
-        # but we can also use FileResponse here:
-        return FileResponse(path=str(target), filename=target.name)
+        return await serve_file(request, target, rel_path, attachment=True)
 
     # Directory listing
     entries = []
@@ -1,19 +1,28 @@
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
+from fastapi import FastAPI, HTTPException, Request, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 
-import os, json, httpx, asyncio
-from typing import Dict, Any
-import asyncio, logging
+import os, httpx, asyncio, anyio
+from typing import Dict, Any, Callable, List
+from contextlib import aclosing
+import asyncio, logging, time
 
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
+from limits import parse as parse_rate_limit
 
 import csv, os
 from datetime import datetime
 
 from server import OLLAMA_BASE
+from tracing import TraceBuffer, Trace, ArrivalTimeMiddleware, REQUEST_ID_HEADER
+from cancellation import CancelStats, ClientDisconnected, call_unless_disconnected, CLIENT_CLOSED_REQUEST
+from scheduling import (Job, JobQueue, LengthEstimator, parse_deadline, num_predict_cap,
+                        DEADLINE_HEADER, DEFAULT_TOKENS_PER_SEC, GENERATION_TIMEOUT, QUEUE_TIMEOUT)
+from degradation import (DegradationController, Decision, resolve_priority, PRIORITY_HEADER, PRIORITY_TOKEN_HEADER,
+                         DEGRADED_HEADER, SERVED_MODEL_HEADER, DEGRADED_MODEL, SHED_RETRY_AFTER)
+from payloads import parse_generate_request, validate_message, loads, dumps, JSON_HEADERS
 
 stream_gate = asyncio.Semaphore(1)
 log = logging.getLogger(__name__)
@@ -32,7 +41,16 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[REQUEST_ID_HEADER, DEGRADED_HEADER, SERVED_MODEL_HEADER, "Retry-After"],
 )
+# outermost, so traces include the time spent in the rate limiter
+app.add_middleware(ArrivalTimeMiddleware)
+
+# recent/slow request traces, served at /debug/requests
+traces = TraceBuffer("load_balancer")
+
+# requests abandoned by the client, served at /stats
+cancel_stats = CancelStats()
 
 limiter = Limiter(key_func=get_remote_address, default_limits=["200/day", "50/hour"])
 app.state.limiter = limiter
@@ -41,9 +59,40 @@ app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 # how many times to retry a request to a different backend on transient network errors
 MAX_RETRIES = 2
 
+# /ws: tokens are batched into one frame per interval (seconds)
+WS_BATCH_INTERVAL = float(os.getenv("WS_BATCH_INTERVAL", "0.05"))
+WS_MAX_STREAMS = int(os.getenv("WS_MAX_STREAMS", "4"))
+WS_MAX_BUFFERED_CHARS = int(os.getenv("WS_MAX_BUFFERED_CHARS", "65536"))
+WS_RATE_LIMIT = parse_rate_limit("1/minute")
+
 # shared HTTP client to benefit from connection pooling
 shared_client: httpx.AsyncClient | None = None
 
+# Node lifecycle. A node that comes back (admin activate or health recovery) first
+# preloads its models with keep_alive, then ramps its routing weight from
+# SLOW_START_MIN_WEIGHT to 1 over SLOW_START_SECONDS before it is fully active.
+WARMUP_MODELS = [m.strip() for m in os.getenv("WARMUP_MODELS", "llama3.1").split(",") if m.strip()]
+if DEGRADED_MODEL and DEGRADED_MODEL not in WARMUP_MODELS:
+    # keep the fallback model resident so switching to it under load costs no load time
+    WARMUP_MODELS.append(DEGRADED_MODEL)
+WARMUP_KEEP_ALIVE = os.getenv("WARMUP_KEEP_ALIVE", "30m")
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "180"))
+SLOW_START_SECONDS = float(os.getenv("SLOW_START_SECONDS", "60"))
+SLOW_START_MIN_WEIGHT = 0.1
+
+# Slots per node when a server entry has no max_concurrency (Ollama's default
+# OLLAMA_NUM_PARALLEL is 4). Beyond that, requests wait in our queue, where they
+# are scheduled shortest-expected-first, instead of in Ollama's FIFO.
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("DEFAULT_MAX_CONCURRENCY", "4"))
+
+run_queue = JobQueue()
+estimator = LengthEstimator()
+# observed generation speed per node, used to turn a deadline into a num_predict cap
+server_tps: Dict[str, float] = {}
+
+# overload handling (smaller model, num_predict cap, shedding), see degradation.py
+degrader = DegradationController()
+
 
 system_prompt = """
 You are the official assistant for the "BDAIO Qualifier Round" ML competition.
@@ -207,7 +256,10 @@ async def _check_server_health(server: Dict[str, Any], timeout: float = 5.0) ->
             body = r.text.strip() if r.text is not None else ""
             ok = r.status_code == 200 and (body == "" or body.lower() in ("ok", "okay", "healthy"))
             elapsed = asyncio.get_event_loop().time() - start
-            server['is_active'] = bool(ok)
+            if ok:
+                mark_server_up(server)
+            else:
+                mark_server_down(server)
             return {
                 'server': server.get('name'),
                 'url': url,
@@ -218,7 +270,7 @@ async def _check_server_health(server: Dict[str, Any], timeout: float = 5.0) ->
             }
     except Exception as e:
         elapsed = asyncio.get_event_loop().time() - start
-        server['is_active'] = False
+        mark_server_down(server)
         return {
             'server': server.get('name'),
             'url': url,
@@ -258,6 +310,9 @@ async def on_startup_health_check():
                 active = sum(1 for r in results if r['ok'])
                 inactive = len(results) - active
                 print(f"[health-loop] Active: {active}, Inactive: {inactive}")
+                # recovered or ramping nodes may have free slots nobody released
+                async with servers_lock:
+                    _dispatch_queued()
             except Exception as e:
                 print("Health loop error:", e)
             await asyncio.sleep(interval)
@@ -278,40 +333,315 @@ async def on_shutdown():
         shared_client = None
 
 
-async def acquire_server():
-    """Select a server (least loaded with round-robin tie-break), increment its load and return it.
+# per-node drain progress and completion callbacks, keyed by server name
+drains: Dict[str, Dict[str, Any]] = {}
+warm_tasks: Dict[str, asyncio.Task] = {}
+
+
+def server_weight(server: dict) -> float:
+    """Routing weight: 1 when active, ramping up while warming, 0 when not routable."""
+    state = server.get('state', 'active')
+    if state == 'active':
+        return 1.0
+    if state != 'warming' or server.get('ramp_started_at') is None:
+        return 0.0
+    frac = (time.monotonic() - server['ramp_started_at']) / SLOW_START_SECONDS if SLOW_START_SECONDS > 0 else 1.0
+    if frac >= 1.0:
+        server['state'] = 'active'
+        server['ramp_started_at'] = None
+        print(f"[lifecycle] {server['name']} finished slow start, now active")
+        return 1.0
+    return SLOW_START_MIN_WEIGHT + (1.0 - SLOW_START_MIN_WEIGHT) * frac
+
+
+async def _warm_up(server: dict):
+    """Preload the node's models with keep_alive, then start the slow-start ramp."""
+    base = f"http://{server['ip']}:{server['port']}"
+    client = shared_client or httpx.AsyncClient()
+    try:
+        for model in server.get('models') or WARMUP_MODELS:
+            try:
+                # an empty generate just loads the model and keeps it resident
+                r = await client.post(f"{base}/generate", json={"model": model, "keep_alive": WARMUP_KEEP_ALIVE},
+                                      timeout=WARMUP_TIMEOUT)
+                print(f"[lifecycle] {server['name']} preloaded {model} -> {r.status_code}")
+            except httpx.HTTPError as e:
+                log.warning("Warm-up of %s on %s failed: %r", model, server['name'], e)
+            if server.get('state') != 'warming':
+                return
+    finally:
+        if client is not shared_client:
+            await client.aclose()
+        warm_tasks.pop(server['name'], None)
+    async with servers_lock:
+        if server.get('state') == 'warming':
+            server['ramp_started_at'] = time.monotonic()
+            print(f"[lifecycle] {server['name']} warm, ramping weight over {SLOW_START_SECONDS:.0f}s")
+
+
+def start_warmup(server: dict):
+    """Put a node into 'warming': no traffic until its models are loaded, then slow start."""
+    server['is_active'] = True
+    server['state'] = 'warming'
+    server['ramp_started_at'] = None
+    if server['name'] not in warm_tasks:
+        warm_tasks[server['name']] = asyncio.create_task(_warm_up(server))
+
+
+def mark_server_up(server: dict):
+    """Health check passed. A node that was down goes through the same warm-up as an admin activate."""
+    if server.get('state') in ('draining', 'disabled'):
+        return  # admin decision, the health loop does not override it
+    if not server.get('is_active') or server.get('state') == 'down':
+        start_warmup(server)
+
+
+def mark_server_down(server: dict):
+    server['is_active'] = False
+    if server.get('state') not in ('draining', 'disabled'):
+        server['state'] = 'down'
+        server['ramp_started_at'] = None
+
+
+def _drain_finished(server: dict) -> List[Callable]:
+    """If a draining node has no work left, disable it and return its callbacks (call outside the lock)."""
+    drain = drains.get(server['name'])
+    if server.get('state') != 'draining' or drain is None or server.get('current_load', 0) > 0:
+        return []
+    server['state'] = 'disabled'
+    drain['finished_at'] = time.time()
+    drain['done'].set()
+    callbacks, drain['callbacks'] = drain['callbacks'], []
+    return callbacks
+
+
+async def _run_drain_callbacks(server: dict, callbacks: List[Callable]):
+    for cb in callbacks:
+        try:
+            res = cb(server)
+            if asyncio.iscoroutine(res):
+                await res
+        except Exception:
+            log.exception("Drain callback for %s failed", server['name'])
+
+
+def _log_drained(server: dict):
+    print(f"[lifecycle] {server['name']} drained, no in-flight requests left")
+
+
+async def drain_server(server: dict, on_drained: Callable | None = None) -> Dict[str, Any]:
+    """Stop routing new work to a node; `on_drained(server)` runs once its in-flight requests finish."""
+    async with servers_lock:
+        if server.get('state') != 'draining':
+            server['state'] = 'draining'
+            server['is_active'] = False
+            server['ramp_started_at'] = None
+            drains[server['name']] = {
+                'started_at': time.time(),
+                'finished_at': None,
+                'in_flight_at_start': server.get('current_load', 0),
+                'done': asyncio.Event(),
+                'callbacks': [_log_drained],
+            }
+        if on_drained is not None:
+            drains[server['name']]['callbacks'].append(on_drained)
+        callbacks = _drain_finished(server)
+    await _run_drain_callbacks(server, callbacks)
+    return drain_status(server)
+
+
+def drain_status(server: dict) -> Dict[str, Any]:
+    drain = drains.get(server['name'])
+    if drain is None:
+        return {'server': server['name'], 'state': server.get('state', 'active'), 'draining': False}
+    end = drain['finished_at'] or time.time()
+    return {
+        'server': server['name'],
+        'state': server.get('state', 'active'),
+        'draining': server.get('state') == 'draining',
+        'drained': drain['done'].is_set(),
+        'in_flight': server.get('current_load', 0),
+        'in_flight_at_start': drain['in_flight_at_start'],
+        'elapsed': round(end - drain['started_at'], 3),
+    }
+
 
+def _routable_weights() -> Dict[str, float]:
+    """Routing weight of every active server. Raises HTTPException(503) when none can take work."""
+    weights = {s['name']: server_weight(s) for s in servers if s.get('is_active')}
+    if not any(w > 0 for w in weights.values()):
+        raise HTTPException(status_code=503, detail="No active backend servers")
+    return weights
+
+
+def _pick_server() -> dict | None:
+    """Take a slot on the least loaded routable server (round-robin tie-break). Call under servers_lock.
+
+    Returns None when every routable server is at capacity.
     Raises HTTPException(503) when no active servers are available.
     """
     global rr_index
-    async with servers_lock:
-        active_servers = [s for s in servers if s.get('is_active')]
-        if not active_servers:
-            raise HTTPException(status_code=503, detail="No active backend servers")
+    weights = _routable_weights()
+    active_servers = [s for s in servers if weights.get(s['name'], 0) > 0]
+
+    # servers below their max_concurrency (scaled down during slow start)
+    pool = [s for s in active_servers
+            if s.get('current_load', 0) < max(1, s.get('max_concurrency', DEFAULT_MAX_CONCURRENCY) * weights[s['name']])]
+    if not pool:
+        return None
 
-        # prefer servers that are below their max_concurrency
-        available = [s for s in active_servers if s.get('current_load', 0) < s.get('max_concurrency', 9999)]
-        pool = available if available else active_servers
+    # find minimal weighted load among the pool; for fully active nodes this is plain least-loaded
+    def score(s):
+        return (s['current_load'] + 1) / weights[s['name']]
+    min_score = min(score(s) for s in pool)
+    candidates = [s for s in pool if score(s) == min_score]
 
-        # find minimal load among the pool
-        min_load = min(s['current_load'] for s in pool)
-        candidates = [s for s in pool if s['current_load'] == min_load]
+    # round-robin among candidates to avoid always picking the first
+    chosen = candidates[rr_index % len(candidates)]
+    rr_index = (rr_index + 1) % max(1, len(candidates))
 
-        # round-robin among candidates to avoid always picking the first
-        chosen = candidates[rr_index % len(candidates)]
-        rr_index = (rr_index + 1) % max(1, len(candidates))
+    chosen['current_load'] += 1
+    return chosen
 
-        chosen['current_load'] += 1
-        return chosen
+
+def _dispatch_queued():
+    """Hand free slots to queued jobs, best first. Call under servers_lock."""
+    while run_queue.has_waiting():
+        try:
+            server = _pick_server()
+        except HTTPException:
+            return
+        if server is None:
+            return
+        # has_waiting() guarantees a live job, and nothing awaits in between
+        run_queue.pop().future.set_result(server)
 
 
-async def release_server(server: dict):
+async def acquire_server(trace: Trace | None = None, job: Job | None = None):
+    """Take a slot on a server, waiting in the scheduling queue if all of them are busy.
+
+    Raises HTTPException(503) when no active servers are available or the queue wait
+    times out, and 504 when the job's deadline passes while it is queued.
+    """
+    queued_at = time.perf_counter()
+    if job is None:
+        job = Job('general', 0, 0.0)
+    async with servers_lock:
+        server = None
+        # only take a free slot directly when nobody is waiting, so we never jump the queue
+        if not run_queue.has_waiting():
+            server = _pick_server()
+        else:
+            _routable_weights()  # still fail fast when the whole fleet is down
+        if server is None:
+            job.future = asyncio.get_running_loop().create_future()
+            run_queue.push(job)
+
+    if server is None:
+        timeout = QUEUE_TIMEOUT
+        remaining = job.remaining()
+        if remaining is not None:
+            timeout = min(timeout, max(0.0, remaining))
+        try:
+            server = await asyncio.wait_for(job.future, timeout)
+        except asyncio.TimeoutError:
+            if remaining is not None and job.remaining() <= 0:
+                raise HTTPException(status_code=504, detail="Deadline passed while queued")
+            raise HTTPException(status_code=503, detail="Timed out waiting for a backend slot")
+        except asyncio.CancelledError:
+            # the slot may have been handed to us just as we were cancelled
+            fut = job.future
+            if fut.done() and not fut.cancelled():
+                with anyio.CancelScope(shield=True):
+                    await release_server(fut.result())
+            raise
+
+    if trace is not None:
+        trace.add_span("queue_wait", queued_at, time.perf_counter())
+    return server
+
+
+async def release_server(server: dict, trace: Trace | None = None):
     """Decrement server current_load under lock. Never go below zero."""
     async with servers_lock:
         try:
             server['current_load'] = max(0, server.get('current_load', 0) - 1)
         except Exception:
             server['current_load'] = 0
+        _dispatch_queued()
+        callbacks = _drain_finished(server)
+    await _run_drain_callbacks(server, callbacks)
+    if trace is not None:
+        trace.mark("release", server=server['name'])
+
+
+def make_job(prompt: str, deadline: Any = None, num_predict: int | None = None) -> Job:
+    """Estimate how long the request will generate; a deadline (seconds) or num_predict caps that estimate."""
+    cls, x, expected = estimator.estimate(prompt)
+    job = Job(cls, x, expected, parse_deadline(None if deadline is None else str(deadline)))
+    cap = num_predict_cap(job, DEFAULT_TOKENS_PER_SEC)
+    if cap is not None:
+        job.expected_tokens = min(job.expected_tokens, cap)
+    if num_predict is not None:
+        job.expected_tokens = min(job.expected_tokens, num_predict)
+    return job
+
+
+def request_priority(request: Request, client_ip: str) -> str:
+    return resolve_priority(client_ip, request.headers.get(PRIORITY_TOKEN_HEADER), request.headers.get(PRIORITY_HEADER))
+
+
+def admit(payload: dict, priority: str, trace: Trace) -> Decision:
+    """Update the degradation level from fleet pressure, then apply it to this request's payload."""
+    busy = slots = 0.0
+    for s in servers:
+        w = server_weight(s) if s.get('is_active') else 0.0
+        if w > 0:
+            slots += max(1, s.get('max_concurrency', DEFAULT_MAX_CONCURRENCY) * w)
+            busy += s.get('current_load', 0)
+    # with no routable node (outage, or all warming up) utilisation says nothing: a smaller
+    # model would not get served sooner, so only the queue depth may move the level
+    degrader.update(busy / slots if slots else 0.0, len(run_queue))
+    decision = degrader.admit(payload, priority)
+    if decision.shed:
+        trace.mark("shed", level=decision.level)
+    elif decision.degraded:
+        trace.mark("degraded", level=decision.level, model=decision.model, num_predict=decision.num_predict)
+    return decision
+
+
+def apply_deadline(payload: dict, job: Job, server: dict):
+    """Pass the job's remaining time budget down as a num_predict cap for this server's speed."""
+    cap = num_predict_cap(job, server_tps.get(server['name'], DEFAULT_TOKENS_PER_SEC))
+    if cap is None:
+        return
+    options = payload.get("options")
+    if not isinstance(options, dict):
+        options = payload["options"] = {}
+    current = options.get("num_predict")
+    if not isinstance(current, int) or current < 0 or current > cap:
+        options["num_predict"] = cap
+
+
+def observe_generation(job: Job, server: dict, final: dict):
+    """Feed Ollama's final counters back into the length estimator and per-node speed."""
+    eval_count = final.get("eval_count")
+    if not eval_count:
+        return
+    estimator.observe(job.cls, job.prompt_tokens, eval_count)
+    eval_duration = final.get("eval_duration")
+    if eval_duration:
+        tps = eval_count / (eval_duration / 1e9)
+        prev = server_tps.get(server['name'])
+        server_tps[server['name']] = tps if prev is None else 0.8 * prev + 0.2 * tps
+
+
+def start_trace(request: Request, endpoint: str, client_ip: str) -> Trace:
+    """Start a trace at the request's arrival time; the gap until now is the rate-limit check."""
+    trace = traces.start(endpoint, client_ip, request.headers.get(REQUEST_ID_HEADER),
+                         getattr(request.state, "arrived_at", None))
+    trace.add_span("rate_limit", trace.start, time.perf_counter())
+    return trace
 
 
 async def get_least_loaded_server():
@@ -337,104 +667,213 @@ async def servers_status():
                 'port': s['port'],
                 'current_load': s.get('current_load', 0),
                 'is_active': bool(s.get('is_active', False)),
+                # weight first: it may finish a slow start and update the state
+                'weight': round(server_weight(s), 3) if s.get('is_active') else 0.0,
+                'state': s.get('state', 'active'),
             }
             for s in servers
         ]
     return JSONResponse({'servers': out})
 
 
+def _find_server(name: str) -> dict:
+    for s in servers:
+        if s['name'] == name:
+            return s
+    raise HTTPException(status_code=404, detail="server not found")
+
+
 @app.post("/servers/{name}/activate")
 async def activate_server(name: str):
+    """Bring a node back. A node still draining is warm and goes straight back to active."""
+    s = _find_server(name)
     async with servers_lock:
-        for s in servers:
-            if s['name'] == name:
-                s['is_active'] = True
-                return JSONResponse({'ok': True, 'server': s['name']})
-    raise HTTPException(status_code=404, detail="server not found")
+        if s.get('state') == 'draining':
+            s['state'] = 'active'
+            s['is_active'] = True
+            drain = drains.pop(s['name'], None)
+            if drain is not None:
+                drain['done'].set()
+        elif s.get('state', 'active') != 'active' or not s.get('is_active'):
+            drains.pop(s['name'], None)
+            start_warmup(s)
+        _dispatch_queued()
+        return JSONResponse({'ok': True, 'server': s['name'], 'state': s['state']})
 
 
 @app.post("/servers/{name}/deactivate")
 async def deactivate_server(name: str):
-    async with servers_lock:
-        for s in servers:
-            if s['name'] == name:
-                s['is_active'] = False
-                return JSONResponse({'ok': True, 'server': s['name']})
-    raise HTTPException(status_code=404, detail="server not found")
+    """Start draining: no new work, in-flight requests finish. Poll GET /servers/{name}/drain for progress."""
+    s = _find_server(name)
+    status = await drain_server(s)
+    return JSONResponse({'ok': True, **status})
+
+
+@app.get("/servers/{name}/drain")
+async def drain_progress(name: str):
+    return JSONResponse(drain_status(_find_server(name)))
 
 
+@app.get("/stats")
+async def stats():
+    return JSONResponse({
+        'cancellations': cancel_stats.snapshot(),
+        'degradation': degrader.snapshot(),
+        'scheduler': {
+            **run_queue.snapshot(),
+            'estimator': estimator.snapshot(),
+            'tokens_per_sec': {k: round(v, 1) for k, v in server_tps.items()},
+        },
+    })
+
+
+@app.get("/debug/requests")
+async def debug_requests(limit: int = 50, fmt: str = Query("json", alias="format"), request_id: str | None = None):
+    """Recent and slowest request traces. `?format=chrome` returns Chrome trace-event JSON."""
+    return JSONResponse(traces.debug_payload(limit, fmt, request_id))
+
 
 @app.post("/generate")
 @limiter.limit("1/minute")
 async def generate(request: Request):
     client_host = request.client.host if request.client else "unknown"
-    payload = await request.json()
-    payload["stream"] = False
-    payload["prompt"] = system_prompt + "\n\n User query is: " + payload.get("prompt", "")
-
-    last_exc = None
-    for attempt in range(1, MAX_RETRIES + 1):
-        server = await acquire_server()
-        OLLAMA_BASE = f"http://{server['ip']}:{server['port']}"
+    trace = start_trace(request, "/generate", client_host)
+    status = "error"
+    decision = None
+    try:
+        with trace.span("parse"):
+            req = await parse_generate_request(request)
+        payload = req.upstream_payload(system_prompt + "\n\n User query is: " + req.prompt, stream=False)
+        decision = admit(payload, request_priority(request, client_host), trace)
+        if decision.shed:
+            status = "shed"
+            raise HTTPException(status_code=503, detail="Overloaded, try again shortly", headers=decision.headers())
+        job = make_job(req.prompt, request.headers.get(DEADLINE_HEADER), payload["options"]["num_predict"])
+
+        last_exc = None
+        for attempt in range(1, MAX_RETRIES + 1):
+            try:
+                with trace.span("acquire_server", attempt=attempt):
+                    server = await call_unless_disconnected(request, acquire_server(trace, job),
+                                                            cleanup=release_server)
+            except ClientDisconnected:
+                status = "client_disconnected"
+                cancel_stats.record_cancelled("/generate", "queued", trace.duration)
+                return Response(status_code=CLIENT_CLOSED_REQUEST, headers=decision.headers())
+            trace.server = server['name']
+            apply_deadline(payload, job, server)
+            OLLAMA_BASE = f"http://{server['ip']}:{server['port']}"
 
-        log_request(client_host, payload.get("prompt", "").strip(), server['name'])
-        print(f"Routing to server: {server['name']} at {server['ip']}:{server['port']} (attempt {attempt}) load={server['current_load']}")
+            with trace.span("log_write"):
+                log_request(client_host, payload.get("prompt", "").strip(), server['name'])
+            print(f"Routing to server: {server['name']} at {server['ip']}:{server['port']} (attempt {attempt}) load={server['current_load']}")
 
-        try:
-            async with httpx.AsyncClient(timeout=300.0) as client:
-                r = await client.post(f"{OLLAMA_BASE}/generate", json=payload)
+            try:
+                with trace.span("upstream", server=server['name'], attempt=attempt):
+                    timeout = GENERATION_TIMEOUT if job.deadline is None else max(0.1, job.remaining())
+                    async with httpx.AsyncClient(timeout=timeout) as client:
+                        r = await call_unless_disconnected(request, client.post(
+                            f"{OLLAMA_BASE}/generate", content=dumps(payload),
+                            headers={**JSON_HEADERS, REQUEST_ID_HEADER: trace.request_id}))
                 if r.status_code != 200:
                     body = r.text if r.text is not None else ""
                     raise HTTPException(r.status_code, body)
-                data = r.json()
-                return JSONResponse({"response": data.get("response", "")})
-        except (httpx.RemoteProtocolError, httpx.ReadError, httpx.ConnectError, httpx.RequestError) as e:
-            log.warning("Upstream failed (attempt %d): %r", attempt, e)
-            last_exc = e
-            async with servers_lock:
-                server['is_active'] = False
-        finally:
-            await release_server(server)
-    raise HTTPException(status_code=503, detail=f"All backend attempts failed: {last_exc}")
-
-
-@app.post("/stream")
-@limiter.limit("1/minute")
-async def stream(request: Request):
-    client_ip = request.client.host if request.client else "unknown"
-    payload = await request.json()
-    payload.setdefault("stream", True)
-
-    log_request(client_ip, payload.get("prompt", "").strip(), "-")
-    payload["prompt"] = system_prompt + "\n\n User query is: " + payload.get("prompt", "")
-
-    # print(payload["prompt"])
-
-    async def ndjson():
+                data = loads(r.content)
+                status = "ok"
+                cancel_stats.record_completed("/generate", trace.duration)
+                observe_generation(job, server, data)
+                return JSONResponse({"response": data.get("response", "")},
+                                    headers={REQUEST_ID_HEADER: trace.request_id, **decision.headers()})
+            except ClientDisconnected:
+                # the upstream connection is closed by now, which makes server.py stop Ollama
+                status = "client_disconnected"
+                trace.mark("client_disconnected")
+                cancel_stats.record_cancelled("/generate", "upstream", trace.duration)
+                return Response(status_code=CLIENT_CLOSED_REQUEST, headers=decision.headers())
+            except (httpx.RemoteProtocolError, httpx.ReadError, httpx.ConnectError, httpx.RequestError) as e:
+                if isinstance(e, httpx.TimeoutException) and job.deadline is not None:
+                    trace.mark("deadline")
+                    raise HTTPException(status_code=504, detail="Deadline passed before generation finished") from e
+                log.warning("Upstream failed (attempt %d): %r", attempt, e)
+                trace.mark("retry", attempt=attempt, error=repr(e))
+                last_exc = e
+                async with servers_lock:
+                    mark_server_down(server)
+            finally:
+                await release_server(server, trace)
+        raise HTTPException(status_code=503, detail=f"All backend attempts failed: {last_exc}")
+    except HTTPException as e:
+        # errors after admission (queue timeout, deadline, upstream failure) still say how we served it
+        if decision is not None:
+            e.headers = {**decision.headers(), **(e.headers or {})}
+        raise
+    finally:
+        traces.finish(trace, status)
+
+
+async def stream_from_backends(payload: dict, job: Job, trace: Trace, endpoint: str):
+    """Yield NDJSON lines for a streaming generation: routing, retries on another node, release.
+
+    Shared by /stream and /ws. Failures after the response has started are reported
+    in-band as a final line with "done_reason".
+    """
+    status = "error"
+    server = None
+    yielded_any = False
+    try:
         for attempt in range(1, MAX_RETRIES + 1):
-            server = await acquire_server()
+            server = None
+            try:
+                with trace.span("acquire_server", attempt=attempt):
+                    server = await acquire_server(trace, job)
+            except HTTPException as e:
+                # the response has already started, so report it in-band as the last line
+                status = "deadline" if e.status_code == 504 else "error"
+                yield dumps({"error": e.detail, "done": True,
+                             "done_reason": "deadline" if e.status_code == 504 else "error"}).decode()
+                return
+            trace.server = server['name']
+            apply_deadline(payload, job, server)
             OLLAMA_BASE = f"http://{server['ip']}:{server['port']}"
             yielded_any = False
             released = False
             print(f"Routing to server: {server['name']} at {server['ip']}:{server['port']} (attempt {attempt}) load={server['current_load']}")
             try:
                 async with httpx.AsyncClient(timeout=None) as client:
-                    async with client.stream("POST", f"{OLLAMA_BASE}/stream", json=payload) as r:
+                    connect = trace.span("upstream_connect", server=server['name'], attempt=attempt)
+                    async with client.stream("POST", f"{OLLAMA_BASE}/stream", content=dumps(payload),
+                                             headers={**JSON_HEADERS, REQUEST_ID_HEADER: trace.request_id}) as r:
+                        connect.end = time.perf_counter()
                         if r.status_code != 200:
                             body = await r.aread()
                             raise HTTPException(r.status_code, body.decode("utf-8", "ignore"))
-                        async for line in r.aiter_lines():
-                            if not line:
-                                continue
-                            yielded_any = True
-                            yield line + "\n"
+                        with trace.span("generation", server=server['name']):
+                            async for line in r.aiter_lines():
+                                if not line:
+                                    continue
+                                if not yielded_any:
+                                    trace.mark("ttft")
+                                yielded_any = True
+                                yield line
+                                if '"eval_count"' in line:
+                                    # only Ollama's final chunk carries the counters
+                                    observe_generation(job, server, loads(line))
+                                elif job.deadline is not None and time.monotonic() > job.deadline:
+                                    trace.mark("deadline")
+                                    yield dumps({"response": "", "done": True, "done_reason": "deadline"}).decode()
+                                    status = "deadline"
+                                    return
+                        trace.mark("stream_end")
+                        status = "ok"
+                        cancel_stats.record_completed(endpoint, trace.duration)
                         return
 
             except (httpx.RemoteProtocolError, httpx.ReadError, httpx.ConnectError, httpx.RequestError) as e:
                 log.warning("Upstream aborted early (attempt %d): %r", attempt, e)
+                trace.mark("retry", attempt=attempt, error=repr(e))
                 async with servers_lock:
-                    server['is_active'] = False
-                await release_server(server)
+                    mark_server_down(server)
+                await release_server(server, trace)
                 released = True
                 if yielded_any:
                     return
@@ -442,10 +881,249 @@ async def stream(request: Request):
                     continue
             finally:
                 if not released:
-                    await release_server(server)
+                    # on a client disconnect we are being cancelled; the slot must still be freed
+                    with anyio.CancelScope(shield=True):
+                        await release_server(server, trace)
         return
+    except (GeneratorExit, asyncio.CancelledError):
+        # the client went away (or cancelled the stream); leaving the httpx context
+        # managers closes the connection to server.py, which stops Ollama in turn
+        status = "client_disconnected"
+        phase = "queued" if server is None else ("streaming" if yielded_any else "prefill")
+        cancel_stats.record_cancelled(endpoint, phase, trace.duration)
+        raise
+    finally:
+        traces.finish(trace, status)
+
 
-    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+@app.post("/stream")
+@limiter.limit("1/minute")
+async def stream(request: Request):
+    client_ip = request.client.host if request.client else "unknown"
+    trace = start_trace(request, "/stream", client_ip)
+    try:
+        with trace.span("parse"):
+            req = await parse_generate_request(request)
+    except Exception:
+        traces.finish(trace, "invalid")
+        raise
+    payload = req.upstream_payload(system_prompt + "\n\n User query is: " + req.prompt, stream=req.stream)
+    decision = admit(payload, request_priority(request, client_ip), trace)
+    if decision.shed:
+        traces.finish(trace, "shed")
+        raise HTTPException(status_code=503, detail="Overloaded, try again shortly", headers=decision.headers())
+    job = make_job(req.prompt, request.headers.get(DEADLINE_HEADER), payload["options"]["num_predict"])
+
+    with trace.span("log_write"):
+        log_request(client_ip, req.prompt.strip(), "-")
+
+    # print(payload["prompt"])
+
+    async def ndjson():
+        async with aclosing(stream_from_backends(payload, job, trace, "/stream")) as lines:
+            async for line in lines:
+                yield line + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson",
+                             headers={REQUEST_ID_HEADER: trace.request_id, **decision.headers()})
+
+
+class WsStream:
+    __slots__ = ("id", "scope", "paused", "buffered", "writable", "cancelled")
+
+    def __init__(self, stream_id: str):
+        self.id = stream_id
+        self.scope: anyio.CancelScope | None = None
+        self.paused = False
+        self.buffered = 0
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.cancelled = False
+
+
+class WsMux:
+    """Many chat streams over one browser WebSocket.
+
+    Tokens are buffered per stream and flushed every WS_BATCH_INTERVAL as a single
+    frame. The flusher is the only writer: "started" and early errors go out before
+    the tokens frame and a stream's "done" after it, so every stream's tokens sit
+    between the two. A stream stops reading upstream while the client has paused it or
+    while more than WS_MAX_BUFFERED_CHARS of it is waiting to be sent.
+    """
+
+    def __init__(self, ws: WebSocket, client_ip: str):
+        self.ws = ws
+        self.client_ip = client_ip
+        self.streams: Dict[str, WsStream] = {}
+        self.pending: Dict[str, List[str]] = {}
+        self.events: List[dict] = []
+
+    def _update_writable(self, st: WsStream):
+        if st.paused or st.buffered > WS_MAX_BUFFERED_CHARS:
+            st.writable.clear()
+        else:
+            st.writable.set()
+
+    async def flusher(self, scope: anyio.CancelScope):
+        try:
+            while True:
+                await asyncio.sleep(WS_BATCH_INTERVAL)
+                await self.flush()
+        except (WebSocketDisconnect, RuntimeError, OSError):
+            scope.cancel()  # the socket is gone, tear the connection down
+
+    async def flush(self):
+        # take both before the first await: a "done" queued during a send must not
+        # overtake tokens that arrived after this snapshot
+        pending, self.pending = self.pending, {}
+        events, self.events = self.events, []
+        # events before the first "done" (started, errors) precede the tokens; from that
+        # "done" on they follow, so a reused stream id still starts after the old one ended
+        first_done = next((i for i, ev in enumerate(events) if ev["type"] == "done"), len(events))
+        for ev in events[:first_done]:
+            await self.ws.send_text(dumps(ev).decode())
+        if pending:
+            chunks = {sid: "".join(parts) for sid, parts in pending.items()}
+            for sid in chunks:
+                st = self.streams.get(sid)
+                if st is not None:
+                    st.buffered = 0
+                    self._update_writable(st)
+            await self.ws.send_text(dumps({"type": "tokens", "chunks": chunks}).decode())
+        for ev in events[first_done:]:
+            await self.ws.send_text(dumps(ev).decode())
+
+    def start(self, tg, msg: dict):
+        sid = msg.get("id")
+        if not isinstance(sid, str) or not sid or sid in self.streams:
+            self.events.append({"type": "error", "id": sid, "detail": "stream id missing or already in use"})
+            return
+        if len(self.streams) >= WS_MAX_STREAMS:
+            self.events.append({"type": "error", "id": sid, "detail": "too many concurrent streams"})
+            return
+        # same per-client budget as POST /stream
+        if limiter.enabled and not limiter.limiter.hit(WS_RATE_LIMIT, "ws", self.client_ip):
+            self.events.append({"type": "error", "id": sid, "detail": f"Rate limit exceeded: {WS_RATE_LIMIT}"})
+            return
+
+        try:
+            req = validate_message(msg)
+        except ValueError as e:
+            self.events.append({"type": "error", "id": sid, "detail": str(e)})
+            return
+
+        trace = traces.start("/ws", self.client_ip)
+        payload = req.upstream_payload(system_prompt + "\n\n User query is: " + req.prompt, stream=True)
+        token = msg.get("priority_token") if isinstance(msg.get("priority_token"), str) else None
+        decision = admit(payload, resolve_priority(self.client_ip, token, msg.get("priority")), trace)
+        if decision.shed:
+            traces.finish(trace, "shed")
+            self.events.append({"type": "error", "id": sid, "detail": "Overloaded, try again shortly",
+                                "shed": True, "retry_after": SHED_RETRY_AFTER})
+            return
+        job = make_job(req.prompt, msg.get("deadline"), payload["options"]["num_predict"])
+        with trace.span("log_write"):
+            log_request(self.client_ip, req.prompt.strip(), "-")
+
+        self.streams[sid] = WsStream(sid)
+        self.events.append({"type": "started", "id": sid, "request_id": trace.request_id,
+                            "degraded": decision.degraded, "model": decision.model})
+        tg.start_soon(self.run_stream, sid, payload, job, trace, decision)
+
+    async def run_stream(self, sid: str, payload: dict, job: Job, trace: Trace, decision: Decision):
+        st = self.streams[sid]
+        done: Dict[str, Any] = {"type": "done", "id": sid, "reason": "stop", "degraded": decision.degraded}
+        with anyio.CancelScope() as scope:
+            st.scope = scope
+            if st.cancelled:
+                scope.cancel()
+            try:
+                async with aclosing(stream_from_backends(payload, job, trace, "/ws")) as lines:
+                    async for line in lines:
+                        chunk = loads(line)
+                        text = chunk.get("response")
+                        if text:
+                            self.pending.setdefault(sid, []).append(text)
+                            st.buffered += len(text)
+                            self._update_writable(st)
+                        if chunk.get("done"):
+                            done["reason"] = chunk.get("done_reason") or "stop"
+                            if chunk.get("error"):
+                                done["detail"] = chunk["error"]
+                            if chunk.get("eval_count"):
+                                done["eval_count"] = chunk["eval_count"]
+                        # backpressure: stop pulling from upstream until the client catches up
+                        await st.writable.wait()
+            except Exception as e:
+                # fail only this stream; the others on the socket keep going
+                log.warning("/ws stream %s failed: %r", sid, e)
+                done["reason"] = "error"
+                done["detail"] = str(getattr(e, "detail", "") or e) or repr(e)
+        if scope.cancelled_caught:
+            done["reason"] = "cancelled"
+        self.streams.pop(sid, None)
+        self.events.append(done)
+
+    def control(self, msg: dict):
+        sid = msg.get("id")
+        st = self.streams.get(sid) if isinstance(sid, str) else None
+        if st is None:
+            self.events.append({"type": "error", "id": sid, "detail": "unknown stream id"})
+            return
+        if msg["type"] == "cancel":
+            st.cancelled = True
+            if st.scope is not None:
+                st.scope.cancel()
+        else:
+            st.paused = msg["type"] == "pause"
+            self._update_writable(st)
+
+
+@app.websocket("/ws")
+async def ws_chat(ws: WebSocket):
+    """Multiplexed chat over one WebSocket. Every message is a JSON text frame.
+
+    Client -> server:
+      {"type": "start", "id": "s1", "prompt": "...", "model": "...", "options": {...}, "deadline": 20,
+       "priority": "low", "priority_token": "..."}
+      {"type": "cancel" | "pause" | "resume", "id": "s1"}
+    Server -> client:
+      {"type": "started", "id": "s1", "request_id": "...", "degraded": false, "model": "..."}
+      {"type": "tokens", "chunks": {"s1": "text since last frame", "s2": "..."}}
+      {"type": "done", "id": "s1", "reason": "stop" | "cancelled" | "deadline" | "error", "degraded": false, ...}
+      {"type": "error", "id": "s1", "detail": "...", "shed": true, "retry_after": 30}
+    """
+    await ws.accept()
+    client_ip = ws.client.host if ws.client else "unknown"
+    mux = WsMux(ws, client_ip)
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(mux.flusher, tg.cancel_scope)
+        try:
+            while True:
+                try:
+                    msg = loads(await ws.receive_text())
+                except WebSocketDisconnect:
+                    break
+                except ValueError:
+                    mux.events.append({"type": "error", "id": None, "detail": "invalid JSON"})
+                    continue
+                kind = msg.get("type") if isinstance(msg, dict) else None
+                try:
+                    if kind == "start":
+                        mux.start(tg, msg)
+                    elif kind in ("cancel", "pause", "resume"):
+                        mux.control(msg)
+                    else:
+                        mux.events.append({"type": "error", "id": None, "detail": f"unknown message type {kind!r}"})
+                except Exception as e:
+                    # one bad message must not take down the other streams on this socket
+                    print(f"[ws] {client_ip}: {kind} failed: {e!r}")
+                    sid = msg.get("id")
+                    mux.events.append({"type": "error", "id": sid if isinstance(sid, str) else None,
+                                       "detail": "could not handle message"})
+        finally:
+            # the browser went away: cancel every stream so their backend slots are released
+            tg.cancel_scope.cancel()
 
 
 @app.get("/healthz")
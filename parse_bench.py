@@ -0,0 +1,155 @@
+"""Measure the load balancer's own CPU cost per request, without Ollama in the loop.
+
+Two parts:
+  1. codec path: parse the client body, serialise the upstream payload and handle the
+     upstream NDJSON lines. "stdlib" is the previous code (json.loads of the whole body,
+     httpx's json= serialisation), "every-line" additionally decodes each streamed
+     chunk, and "current" is pydantic validate-from-JSON plus orjson. All of them
+     decode only the final chunk unless stated.
+  2. end to end: POST /generate and /stream through the real FastAPI app in-process,
+     with server.py replaced by an httpx mock transport, many requests in flight.
+     CPU is process time, so waiting does not count. CSV logging and console
+     prints are switched off, since they measure the disk and terminal instead. The
+     test client and the mock run in the same process, so this is an upper bound.
+
+Usage:
+  python3 parse_bench.py
+  python3 parse_bench.py --requests 4000 --concurrency 200 --tokens 300
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import types
+
+import httpx
+
+import load_balancer as lb
+from payloads import GenerateRequest, dumps, loads
+
+# what the web UI sends today
+UI_BODY = {
+    "model": "llama3.1", "prompt": "How do I compute macro F1 with scikit-learn for the submission file?",
+    "stream": True, "seed": 42, "num_predict": 10, "mirostat": 0, "temperature": 0.2, "top_k": 0, "top_p": 1.0,
+    "typical_p": 1.0, "min_p": 0.0, "repeat_last_n": 64, "repeat_penalty": 1.05, "presence_penalty": 0.0,
+    "frequency_penalty": 0.0, "penalize_newline": False, "stop": ["user:"], "num_ctx": 10, "num_keep": -1,
+    "numa": False, "num_thread": 8, "num_batch": 128, "num_gpu": -1, "main_gpu": 0, "low_vram": False,
+    "use_mmap": True, "use_mlock": False, "vocab_only": False, "options": {"num_predict": 512},
+}
+
+
+def ndjson_lines(tokens: int) -> list:
+    lines = [json.dumps({"model": "llama3.1", "created_at": "2025-10-20T10:00:00Z", "response": f"tok{i} ",
+                         "done": False}) for i in range(tokens)]
+    lines.append(json.dumps({"model": "llama3.1", "response": "", "done": True, "done_reason": "stop",
+                             "eval_count": tokens, "eval_duration": tokens * 50_000_000}))
+    return lines
+
+
+def stdlib_path(body: bytes, lines: list):
+    payload = json.loads(body)
+    payload["prompt"] = lb.system_prompt + "\n\n User query is: " + payload.get("prompt", "")
+    json.dumps(payload).encode()
+    for line in lines:
+        if '"eval_count"' in line:
+            json.loads(line)
+
+
+def every_line_path(body: bytes, lines: list):
+    payload = json.loads(body)
+    payload["prompt"] = lb.system_prompt + "\n\n User query is: " + payload.get("prompt", "")
+    json.dumps(payload).encode()
+    for line in lines:
+        json.loads(line)
+
+
+def current_path(body: bytes, lines: list):
+    req = GenerateRequest.model_validate_json(body)
+    dumps(req.upstream_payload(lb.system_prompt + "\n\n User query is: " + req.prompt, stream=True))
+    for line in lines:
+        if '"eval_count"' in line:
+            loads(line)
+
+
+def bench_codec(n: int, tokens: int):
+    body = json.dumps(UI_BODY).encode()
+    lines = ndjson_lines(tokens)
+    print(f"codec path, {tokens} upstream lines per request (CPU microseconds per request)")
+    for name, fn in (("every-line", every_line_path), ("stdlib", stdlib_path), ("current", current_path)):
+        fn(body, lines)
+        t0 = time.process_time()
+        for _ in range(n):
+            fn(body, lines)
+        print(f"  {name:10} {(time.process_time() - t0) / n * 1e6:9.1f}")
+
+
+def mock_upstream(tokens: int) -> httpx.MockTransport:
+    stream_body = ("\n".join(ndjson_lines(tokens)) + "\n").encode()
+    generate_body = json.dumps({"response": "ok " * tokens, "eval_count": tokens,
+                                "eval_duration": tokens * 50_000_000}).encode()
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/stream":
+            return httpx.Response(200, content=stream_body, headers={"content-type": "application/x-ndjson"})
+        return httpx.Response(200, content=generate_body, headers={"content-type": "application/json"})
+
+    return httpx.MockTransport(handler)
+
+
+async def bench_app(n: int, concurrency: int, tokens: int):
+    transport = mock_upstream(tokens)
+
+    class UpstreamClient(httpx.AsyncClient):
+        def __init__(self, *args, **kwargs):
+            kwargs["transport"] = transport
+            super().__init__(*args, **kwargs)
+
+    # only the balancer's upstream client is redirected; everything else is the real app
+    lb.httpx = types.SimpleNamespace(**{**vars(httpx), "AsyncClient": UpstreamClient})
+    lb.servers[:] = [{'name': 'bench', 'ip': '127.0.0.1', 'port': '1', 'current_load': 0, 'is_active': True,
+                      'max_concurrency': concurrency + 1}]
+    lb.limiter.enabled = False
+    lb.log_request = lambda *args: None
+    lb.print = lambda *args, **kwargs: None  # per-request routing lines would drown the table
+
+    body = json.dumps(UI_BODY).encode()
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=lb.app), base_url="http://lb")
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(path: str) -> int:
+        async with sem:
+            if path == "/stream":
+                async with client.stream("POST", path, content=body, headers={"content-type": "application/json"}) as r:
+                    async for _ in r.aiter_raw():
+                        pass
+                    return r.status_code
+            r = await client.post(path, content=body, headers={"content-type": "application/json"})
+            return r.status_code
+
+    print(f"end to end, {concurrency} in flight, {tokens} tokens per answer")
+    print(f"  {'endpoint':10} {'req/s':>8} {'CPU us/req':>11} {'errors':>7}")
+    for path in ("/generate", "/stream"):
+        await asyncio.gather(*(one(path) for _ in range(min(n, 50))))  # warm up
+        t0, c0 = time.perf_counter(), time.process_time()
+        codes = await asyncio.gather(*(one(path) for _ in range(n)))
+        wall, cpu = time.perf_counter() - t0, time.process_time() - c0
+        errors = sum(1 for c in codes if c != 200)
+        print(f"  {path:10} {n / wall:8.0f} {cpu / n * 1e6:11.1f} {errors:7d}")
+    await client.aclose()
+
+
+def main() -> int:
+    p = argparse.ArgumentParser(description="Per-request CPU cost of the load balancer")
+    p.add_argument("--requests", type=int, default=2000, help="Requests per endpoint")
+    p.add_argument("--concurrency", type=int, default=100, help="Requests in flight at once")
+    p.add_argument("--tokens", type=int, default=200, help="Streamed lines per answer")
+    args = p.parse_args()
+
+    bench_codec(args.requests, args.tokens)
+    asyncio.run(bench_app(args.requests, args.concurrency, args.tokens))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,128 @@
+"""Request parsing and validation for the load balancer, plus the JSON codec it uses.
+
+Bodies are size-checked while they are read and then parsed and validated in one pass
+by pydantic (`model_validate_json`), so the balancer never builds an intermediate dict
+from untrusted input. What goes upstream is rebuilt from the validated model: only
+allowlisted Ollama options, a capped num_predict, and a bounded prompt. Unknown
+top-level fields are dropped rather than rejected, because the web UI sends sampler
+settings at the top level, where Ollama ignores them anyway.
+
+`loads`/`dumps` use orjson when it is installed and fall back to the stdlib.
+"""
+
+import os
+from typing import Any, Dict, List, Optional
+
+from fastapi import HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator
+
+try:
+    import orjson
+
+    loads = orjson.loads
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:  # pragma: no cover - orjson is in requirements.txt
+    import json
+
+    loads = json.loads
+
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", str(64 * 1024)))
+MAX_PROMPT_CHARS = int(os.getenv("MAX_PROMPT_CHARS", "8000"))
+MAX_NUM_PREDICT = int(os.getenv("MAX_NUM_PREDICT", "2048"))
+DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "llama3.1")
+# comma separated; empty allows any model name
+ALLOWED_MODELS = {m.strip() for m in os.getenv("ALLOWED_MODELS", "").split(",") if m.strip()}
+
+
+class GenerationOptions(BaseModel):
+    """Ollama sampling options clients may set. Anything else (num_ctx, num_gpu, ...) is dropped."""
+    model_config = ConfigDict(extra="ignore")
+
+    num_predict: int = Field(MAX_NUM_PREDICT, ge=1, le=MAX_NUM_PREDICT)
+    temperature: Optional[float] = Field(None, ge=0.0, le=2.0)
+    top_k: Optional[int] = Field(None, ge=0, le=1000)
+    top_p: Optional[float] = Field(None, ge=0.0, le=1.0)
+    min_p: Optional[float] = Field(None, ge=0.0, le=1.0)
+    typical_p: Optional[float] = Field(None, ge=0.0, le=1.0)
+    repeat_penalty: Optional[float] = Field(None, ge=0.0, le=2.0)
+    repeat_last_n: Optional[int] = Field(None, ge=-1, le=4096)
+    presence_penalty: Optional[float] = Field(None, ge=-2.0, le=2.0)
+    frequency_penalty: Optional[float] = Field(None, ge=-2.0, le=2.0)
+    seed: Optional[int] = None
+    stop: Optional[List[str]] = Field(None, max_length=4)
+
+    @field_validator("stop")
+    @classmethod
+    def _short_stops(cls, v: Optional[List[str]]) -> Optional[List[str]]:
+        if v is not None and any(len(s) > 64 for s in v):
+            raise ValueError("stop sequences must be at most 64 characters")
+        return v
+
+
+class GenerateRequest(BaseModel):
+    """Body of POST /generate, POST /stream and /ws "start" messages."""
+    model_config = ConfigDict(extra="ignore")
+
+    model: str = Field(DEFAULT_MODEL, min_length=1, max_length=100, pattern=r"^[\w.:/-]+$")
+    prompt: str = Field(..., min_length=1, max_length=MAX_PROMPT_CHARS)
+    stream: bool = True
+    options: GenerationOptions = Field(default_factory=GenerationOptions)
+
+    @field_validator("model")
+    @classmethod
+    def _allowed_model(cls, v: str) -> str:
+        if ALLOWED_MODELS and v not in ALLOWED_MODELS:
+            raise ValueError(f"model must be one of: {', '.join(sorted(ALLOWED_MODELS))}")
+        return v
+
+    def upstream_payload(self, prompt: str, stream: bool) -> Dict[str, Any]:
+        """The dict sent to server.py; later steps (degradation, deadlines) may still edit it."""
+        return {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": stream,
+            "options": self.options.model_dump(exclude_none=True),
+        }
+
+
+async def read_body(request: Request) -> bytes:
+    """Read the request body, refusing with 413 as soon as it grows past MAX_BODY_BYTES."""
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > MAX_BODY_BYTES:
+        raise HTTPException(status_code=413, detail=f"Request body over {MAX_BODY_BYTES} bytes")
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            raise HTTPException(status_code=413, detail=f"Request body over {MAX_BODY_BYTES} bytes")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+async def parse_generate_request(request: Request) -> GenerateRequest:
+    """Parse and validate an HTTP body; invalid input gets FastAPI's usual 422 response."""
+    body = await read_body(request)
+    try:
+        return GenerateRequest.model_validate_json(body)
+    except ValidationError as e:
+        # no "input" echo: it would send an oversized prompt straight back
+        raise RequestValidationError(e.errors(include_url=False, include_input=False)) from e
+
+
+def validate_message(msg: Dict[str, Any]) -> GenerateRequest:
+    """Validate an already decoded /ws message. Raises ValueError with a readable reason."""
+    try:
+        return GenerateRequest.model_validate(msg)
+    except ValidationError as e:
+        err = e.errors(include_url=False, include_input=False)[0]
+        where = ".".join(str(p) for p in err["loc"])
+        raise ValueError(f"{where}: {err['msg']}" if where else err["msg"]) from e
@@ -0,0 +1,151 @@
+"""Replay logs.csv through a simulated fleet to compare FIFO with shortest-expected-job-first.
+
+Arrival times and prompts come from logs.csv (sped up by --speedup). The logs do not
+record how many tokens each answer had, so the true output length is synthetic. The
+scheduler only sees what the balancer would see: the estimate from `LengthEstimator`,
+which learns online from the simulated `eval_count` of finished requests.
+
+Two length models are run. "by-class" draws each length around a mean for the prompt's
+keyword class, i.e. the same classes the estimator uses, so it shows SEJF at its best
+and part of its gain there comes from how the benchmark is built. "uniform" draws every
+length from one distribution (same overall mean, still growing a little with prompt
+length), so the classes carry no information; treat it as the pessimistic bound. A job that would wait longer
+than QUEUE_TIMEOUT gets a 503 in the live balancer; here it is counted as a timeout
+and never runs.
+
+Usage:
+  python3 replay_bench.py
+  python3 replay_bench.py --slots 8 --speedup 7 --tps 20 --aging 5 --max-wait 60
+"""
+
+import argparse
+import csv
+import heapq
+import math
+import random
+from datetime import datetime
+from typing import Dict, List
+
+from scheduling import (Job, JobQueue, LengthEstimator, classify, prompt_tokens, SJF_AGING_TOKENS_PER_SEC,
+                        SJF_MAX_WAIT, QUEUE_TIMEOUT)
+
+TRUE_MEAN_TOKENS = {'short': 90.0, 'explain': 300.0, 'general': 220.0, 'long': 750.0}
+
+
+def load_requests(path: str, speedup: float, seed: int, lengths: str = "by-class") -> List[dict]:
+    rng = random.Random(seed)
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    times = [datetime.strptime(r["date_time"], "%Y-%m-%d %H:%M:%S").timestamp() for r in rows]
+    t0 = min(times)
+    classes = [classify(r["prompt"]) for r in rows]
+    # "uniform" uses the by-class mean over this log's mix, so both models load the fleet equally
+    overall_mean = sum(TRUE_MEAN_TOKENS[c] for c in classes) / len(classes)
+    out = []
+    for r, t, cls in zip(rows, times, classes):
+        prompt = r["prompt"]
+        mean = TRUE_MEAN_TOKENS[cls] if lengths == "by-class" else overall_mean
+        true_tokens = min(2048, int(mean * math.exp(rng.gauss(0, 0.5)) + 0.2 * prompt_tokens(prompt)))
+        # logs have 1s resolution; spread requests inside their second
+        out.append({'arrival': (t - t0 + rng.random()) / speedup, 'prompt': prompt, 'cls': cls, 'tokens': true_tokens})
+    out.sort(key=lambda r: r['arrival'])
+    return out
+
+
+def simulate(requests: List[dict], policy: str, slots: int, tps: float, aging: float, max_wait: float,
+             timeout: float) -> List[dict]:
+    """Discrete-event simulation of `slots` generation slots fed by a JobQueue."""
+    queue = JobQueue(policy=policy, aging=aging, max_wait=max_wait)
+    estimator = LengthEstimator()
+    running: list = []  # heap of (finish_time, seq, request, job)
+    free = slots
+    done = []
+    seq = 0
+    waiting: Dict[int, dict] = {}  # id(job) -> request, where the balancer would keep a future
+
+    def start(now: float, req: dict, job: Job):
+        nonlocal free, seq
+        free -= 1
+        req['start'] = now
+        service = req['tokens'] / tps + prompt_tokens(req['prompt']) / 500.0
+        heapq.heappush(running, (now + service, seq, req, job))
+        seq += 1
+
+    for req in requests + [None]:
+        now = req['arrival'] if req is not None else math.inf
+        # finish everything that completes before the next arrival, refilling slots from the queue
+        while running and running[0][0] <= now:
+            t, _, r, job = heapq.heappop(running)
+            r['finish'] = t
+            estimator.observe(job.cls, job.prompt_tokens, r['tokens'])
+            done.append(r)
+            free += 1
+            while True:
+                nxt = queue.pop(now=t)
+                if nxt is None or t - nxt.enqueued_at <= timeout:
+                    break
+                # gave up in the queue before this slot freed
+                r = waiting.pop(id(nxt))
+                r['timed_out'] = True
+                done.append(r)
+            if nxt is not None:
+                start(t, waiting.pop(id(nxt)), nxt)
+        if req is None:
+            break
+        cls, x, expected = estimator.estimate(req['prompt'])
+        job = Job(cls, x, expected)
+        job.enqueued_at = req['arrival']
+        if free > 0 and not len(queue):
+            start(now, req, job)
+        else:
+            waiting[id(job)] = req
+            queue.push(job)
+    return done
+
+
+def summarize(results: List[dict]) -> Dict[str, float]:
+    done = [r for r in results if not r.get('timed_out')]
+    lat = sorted(r['finish'] - r['arrival'] for r in done)
+    wait = sorted(r['start'] - r['arrival'] for r in done)
+    short = sorted(r['finish'] - r['arrival'] for r in done if r['cls'] == 'short')
+
+    def pct(v: List[float], q: float) -> float:
+        return v[max(0, math.ceil(q / 100 * len(v)) - 1)] if v else float("nan")
+
+    return {
+        'mean': sum(lat) / len(lat),
+        'p50': pct(lat, 50),
+        'p95': pct(lat, 95),
+        'p99': pct(lat, 99),
+        'max': lat[-1],
+        'wait_p50': pct(wait, 50),
+        'short_p50': pct(short, 50),
+        'timeouts': len(results) - len(done),
+    }
+
+
+def main() -> int:
+    p = argparse.ArgumentParser(description="Replay logs.csv to compare FIFO and SEJF scheduling")
+    p.add_argument("--logs", default="logs.csv", help="Request log to replay")
+    p.add_argument("--slots", type=int, default=8, help="Concurrent generation slots in the fleet")
+    p.add_argument("--tps", type=float, default=20.0, help="Tokens/sec of one slot")
+    p.add_argument("--speedup", type=float, default=7.0, help="Replay the log this many times faster")
+    p.add_argument("--aging", type=float, default=SJF_AGING_TOKENS_PER_SEC, help="SEJF aging (tokens per second waited)")
+    p.add_argument("--max-wait", type=float, default=SJF_MAX_WAIT, help="SEJF serves jobs waiting this long first")
+    p.add_argument("--timeout", type=float, default=QUEUE_TIMEOUT, help="Queue wait that ends in a 503")
+    p.add_argument("--seed", type=int, default=1)
+    args = p.parse_args()
+
+    print(f"{'lengths':9} {'policy':6} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'wait p50':>9} "
+          f"{'short p50':>10} {'timeouts':>9}")
+    for lengths in ("by-class", "uniform"):
+        for policy in ("fifo", "sejf"):
+            requests = load_requests(args.logs, args.speedup, args.seed, lengths)
+            s = summarize(simulate(requests, policy, args.slots, args.tps, args.aging, args.max_wait, args.timeout))
+            print(f"{lengths:9} {policy:6} {s['mean']:8.1f} {s['p50']:8.1f} {s['p95']:8.1f} {s['p99']:8.1f} "
+                  f"{s['max']:8.1f} {s['wait_p50']:9.1f} {s['short_p50']:10.1f} {s['timeouts']:9d}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,208 @@
+"""Shortest-expected-job-first scheduling for the load balancer.
+
+When every backend slot is busy, requests wait in a queue instead of piling onto
+Ollama's own FIFO. The queue is ordered by how many tokens each request is expected
+to generate, so a quick "where do I import X from" does not wait behind a long
+"write a full training pipeline". Waiting requests age: every second in the queue
+counts as SJF_AGING_TOKENS_PER_SEC fewer expected tokens. Aging alone is slow for long
+jobs, so a job that has waited SJF_MAX_WAIT seconds is served next (oldest first),
+which keeps waits well under QUEUE_TIMEOUT.
+
+The expected length comes from `LengthEstimator`, a small online model: the prompt
+is put into a keyword class, and per class a decayed least-squares fit maps prompt
+length to the `eval_count` Ollama reported for past requests.
+"""
+
+import heapq, itertools, math, os, time
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+SCHEDULER_POLICY = os.getenv("SCHEDULER_POLICY", "sejf")  # "sejf" or "fifo"
+SJF_AGING_TOKENS_PER_SEC = float(os.getenv("SJF_AGING_TOKENS_PER_SEC", "5"))
+QUEUE_TIMEOUT = float(os.getenv("QUEUE_TIMEOUT", "120"))
+SJF_MAX_WAIT = float(os.getenv("SJF_MAX_WAIT", str(QUEUE_TIMEOUT / 2)))
+
+# optional client time budget in seconds, e.g. "X-Deadline: 20"
+DEADLINE_HEADER = "X-Deadline"
+GENERATION_TIMEOUT = float(os.getenv("GENERATION_TIMEOUT", "300"))
+# longer budgets are clamped: nothing waits or generates for more than this anyway
+MAX_DEADLINE = QUEUE_TIMEOUT + GENERATION_TIMEOUT
+DEFAULT_TOKENS_PER_SEC = 20.0
+MIN_NUM_PREDICT = 16
+
+KEYWORD_CLASSES: List[Tuple[str, Tuple[str, ...]]] = [
+    ('long', ("write a full", "full code", "complete code", "pipeline", "end-to-end", "end to end",
+              "from scratch", "implement", "project", "step by step")),
+    ('explain', ("explain", "why", "difference", "compare", "describe", "what are", "intuition")),
+    ('short', ("import", "where", "which", "error", "syntax", "what is", "how to", "how do i", "version",
+               "install")),
+]
+# output tokens assumed for a class before we have seen any of its requests
+CLASS_PRIORS = {'short': 120.0, 'explain': 300.0, 'general': 250.0, 'long': 600.0}
+
+
+def prompt_tokens(prompt: str) -> int:
+    # ~4 characters per token is close enough for scheduling
+    return max(1, len(prompt) // 4)
+
+
+def classify(prompt: str) -> str:
+    p = prompt.lower()
+    for cls, words in KEYWORD_CLASSES:
+        if any(w in p for w in words):
+            return cls
+    return 'general'
+
+
+class LengthEstimator:
+    """Per-class online linear fit of output tokens on prompt tokens, blended with a prior."""
+
+    def __init__(self, decay: float = 0.98, min_samples: int = 5):
+        self.decay = decay
+        self.min_samples = min_samples
+        # class -> [n, sum_x, sum_y, sum_xx, sum_xy], exponentially decayed
+        self.sums: Dict[str, List[float]] = {}
+        self.observed = 0
+
+    def estimate(self, prompt: str) -> Tuple[str, int, float]:
+        """Return (class, prompt tokens, expected output tokens)."""
+        cls = classify(prompt)
+        x = prompt_tokens(prompt)
+        prior = CLASS_PRIORS[cls]
+        s = self.sums.get(cls)
+        if not s or s[0] <= 0:
+            return cls, x, prior
+        n, sx, sy, sxx, sxy = s
+        denom = n * sxx - sx * sx
+        if denom > 1e-6 * max(1.0, n * sxx):
+            slope = (n * sxy - sx * sy) / denom
+            fit = (sy - slope * sx) / n + slope * x
+        else:
+            fit = sy / n
+        w = n / (n + self.min_samples)
+        return cls, x, min(4096.0, max(float(MIN_NUM_PREDICT), w * fit + (1 - w) * prior))
+
+    def observe(self, cls: str, x: int, eval_count: int):
+        s = self.sums.setdefault(cls, [0.0, 0.0, 0.0, 0.0, 0.0])
+        for i in range(5):
+            s[i] *= self.decay
+        s[0] += 1
+        s[1] += x
+        s[2] += eval_count
+        s[3] += x * x
+        s[4] += x * eval_count
+        self.observed += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'observed': self.observed,
+            'mean_tokens': {cls: round(s[2] / s[0], 1) for cls, s in self.sums.items() if s[0] > 0},
+        }
+
+
+class Job:
+    """A request waiting for (or holding) a backend slot."""
+    __slots__ = ("cls", "prompt_tokens", "expected_tokens", "enqueued_at", "deadline", "future")
+
+    def __init__(self, cls: str, prompt_tokens: int, expected_tokens: float, deadline: Optional[float] = None):
+        self.cls = cls
+        self.prompt_tokens = prompt_tokens
+        self.expected_tokens = expected_tokens
+        self.enqueued_at = time.monotonic()
+        self.deadline = deadline  # time.monotonic() value, or None
+        self.future = None
+
+    def remaining(self) -> Optional[float]:
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+
+def parse_deadline(value: Optional[str]) -> Optional[float]:
+    """Turn a relative deadline header (seconds) into an absolute monotonic time."""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        return None
+    if not math.isfinite(seconds) or seconds <= 0:
+        return None
+    return time.monotonic() + min(seconds, MAX_DEADLINE)
+
+
+def num_predict_cap(job: Job, tokens_per_sec: float) -> Optional[int]:
+    """Most tokens that can still be generated before the job's deadline."""
+    remaining = job.remaining()
+    if remaining is None:
+        return None
+    return max(MIN_NUM_PREDICT, int(remaining * tokens_per_sec))
+
+
+class JobQueue:
+    """Min-heap of waiting jobs, plus an arrival-order deque for jobs past max_wait.
+
+    Since all waiters age at the same rate, ordering by
+    `expected_tokens - aging * waited` equals ordering by
+    `expected_tokens + aging * enqueued_at`, which never changes, so a heap works.
+    A job taken through one structure is left in the other and skipped later.
+    """
+
+    def __init__(self, policy: str = SCHEDULER_POLICY, aging: float = SJF_AGING_TOKENS_PER_SEC,
+                 max_wait: float = SJF_MAX_WAIT):
+        self.policy = policy
+        self.aging = aging
+        self.max_wait = max_wait
+        self.heap: list = []
+        self.arrivals: deque = deque()
+        self._seq = itertools.count()
+        # jobs still waiting; abandoned ones stay in the heap until popped, but not here
+        self.live: set = set()
+
+    def key(self, job: Job) -> float:
+        if self.policy == 'fifo':
+            return job.enqueued_at
+        return job.expected_tokens + self.aging * job.enqueued_at
+
+    def push(self, job: Job):
+        heapq.heappush(self.heap, (self.key(job), next(self._seq), job))
+        self.arrivals.append(job)
+        self.live.add(job)
+        if job.future is not None:
+            job.future.add_done_callback(lambda _f: self.live.discard(job))
+
+    def _gone(self, job: Job) -> bool:
+        # taken already, or abandoned (the done callback may not have run yet)
+        return job not in self.live or (job.future is not None and job.future.done())
+
+    def pop(self, now: Optional[float] = None) -> Optional[Job]:
+        """Next job that is still waiting; abandoned ones are dropped."""
+        while self.arrivals and self._gone(self.arrivals[0]):
+            self.arrivals.popleft()
+        if self.arrivals:
+            now = time.monotonic() if now is None else now
+            if now - self.arrivals[0].enqueued_at >= self.max_wait:
+                job = self.arrivals.popleft()
+                self.live.discard(job)
+                return job
+        while self.heap:
+            _, _, job = heapq.heappop(self.heap)
+            if not self._gone(job):
+                self.live.discard(job)
+                return job
+        return None
+
+    def has_waiting(self) -> bool:
+        while self.heap and self._gone(self.heap[0][2]):
+            heapq.heappop(self.heap)
+        return bool(self.heap)
+
+    def __len__(self) -> int:
+        """Jobs still waiting."""
+        return len(self.live)
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            'policy': self.policy,
+            'queued': len(self.live),
+            'oldest_wait': round(max((now - j.enqueued_at for j in self.live), default=0.0), 3),
+        }
@@ -1,7 +1,9 @@
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
+from fastapi import FastAPI, HTTPException, Request, Query
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-import os, json, httpx, asyncio
+import os, json, httpx, asyncio, time
+from tracing import TraceBuffer, ArrivalTimeMiddleware, REQUEST_ID_HEADER
+from cancellation import CancelStats, ClientDisconnected, call_unless_disconnected, CLIENT_CLOSED_REQUEST
 
 OLLAMA_BASE = os.getenv("OLLAMA_BASE_URL", "http://127.0.0.1:11434")
 
@@ -14,38 +16,101 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[REQUEST_ID_HEADER],
 )
+app.add_middleware(ArrivalTimeMiddleware)
+
+# traces share the request ID the load balancer sends, so both sides can be joined
+traces = TraceBuffer("server")
+
+# generations stopped because the client (the load balancer) went away
+cancel_stats = CancelStats()
+
+
+def start_trace(request: Request, endpoint: str):
+    client_ip = request.client.host if request.client else "unknown"
+    return traces.start(endpoint, client_ip, request.headers.get(REQUEST_ID_HEADER),
+                        getattr(request.state, "arrived_at", None))
 
 
 @app.post("/generate")
 async def generate(req: Request):
-    payload = await req.json()
-    payload["stream"] = False
-    async with httpx.AsyncClient(timeout=300.0) as client:
-        r = await client.post(f"{OLLAMA_BASE}/api/generate", json=payload)
-        if r.status_code != 200:
-            raise HTTPException(r.status_code, r.text)
-        data = r.json()
-        return JSONResponse({"response": data.get("response", "")})
+    trace = start_trace(req, "/generate")
+    status = "error"
+    try:
+        payload = await req.json()
+        payload["stream"] = False
+        async with httpx.AsyncClient(timeout=300.0) as client:
+            with trace.span("ollama_generate", model=payload.get("model")):
+                # closing the connection is what makes Ollama abort the generation
+                r = await call_unless_disconnected(req, client.post(f"{OLLAMA_BASE}/api/generate", json=payload))
+            if r.status_code != 200:
+                raise HTTPException(r.status_code, r.text)
+            data = r.json()
+            status = "ok"
+            cancel_stats.record_completed("/generate", trace.duration)
+            # the counters let the load balancer learn how long answers get
+            return JSONResponse({"response": data.get("response", ""),
+                                 "eval_count": data.get("eval_count"),
+                                 "eval_duration": data.get("eval_duration")},
+                                headers={REQUEST_ID_HEADER: trace.request_id})
+    except ClientDisconnected:
+        status = "client_disconnected"
+        cancel_stats.record_cancelled("/generate", "upstream", trace.duration)
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    finally:
+        traces.finish(trace, status)
 
 
 @app.post("/stream")
 async def stream(request: Request):
+    trace = start_trace(request, "/stream")
     payload = await request.json()
     payload.setdefault("stream", True)
 
     async def ndjson():
-        async with httpx.AsyncClient(timeout=None) as client:
-            async with client.stream("POST", f"{OLLAMA_BASE}/api/generate", json=payload) as r:
-                if r.status_code != 200:
-                    body = await r.aread()
-                    raise HTTPException(r.status_code, body.decode("utf-8", "ignore"))
-                async for line in r.aiter_lines():
-                    if not line:
-                        continue
-                    yield line + "\n"
-
-    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+        status = "error"
+        first = True
+        try:
+            async with httpx.AsyncClient(timeout=None) as client:
+                connect = trace.span("ollama_connect", model=payload.get("model"))
+                async with client.stream("POST", f"{OLLAMA_BASE}/api/generate", json=payload) as r:
+                    connect.end = time.perf_counter()
+                    if r.status_code != 200:
+                        body = await r.aread()
+                        raise HTTPException(r.status_code, body.decode("utf-8", "ignore"))
+                    with trace.span("generation"):
+                        async for line in r.aiter_lines():
+                            if not line:
+                                continue
+                            if first:
+                                trace.mark("ttft")
+                                first = False
+                            yield line + "\n"
+                    trace.mark("stream_end")
+                    status = "ok"
+                    cancel_stats.record_completed("/stream", trace.duration)
+        except (GeneratorExit, asyncio.CancelledError):
+            # leaving the httpx context managers closes the Ollama connection and stops generation
+            status = "client_disconnected"
+            cancel_stats.record_cancelled("/stream", "prefill" if first else "streaming", trace.duration)
+            raise
+        finally:
+            traces.finish(trace, status)
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson",
+                             headers={REQUEST_ID_HEADER: trace.request_id})
+
+
+@app.get("/stats")
+async def stats():
+    return JSONResponse({'cancellations': cancel_stats.snapshot()})
+
+
+@app.get("/debug/requests")
+async def debug_requests(limit: int = 50, fmt: str = Query("json", alias="format"), request_id: str | None = None):
+    """Recent and slowest request traces. `?format=chrome` returns Chrome trace-event JSON."""
+    return JSONResponse(traces.debug_payload(limit, fmt, request_id))
 
 
 # --- Quick health check ---
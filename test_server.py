@@ -2,11 +2,16 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import json
+import math
+import sys
 import time
 import urllib.request
 import urllib.error
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
 servers = [
     {
@@ -96,10 +101,16 @@ Features:
 - Synchronous and concurrent checks (default: concurrent)
 - Optional JSON output (--json)
 - Returns non-zero exit code if --fail-on-unhealthy and any server is unhealthy
+- Prober mode (--probe): sends a small canary prompt to each node's `/stream`,
+  measures connect time, TTFT, tokens/sec and total time, keeps rolling
+  percentiles per node, checks them against SLOs and writes JSON lines.
+  Exits with code 3 if any node violates its SLOs after the last round.
 
 Usage:
   python3 test_server.py            # run with defaults
   python3 test_server.py --timeout 2 --json
+  python3 test_server.py --probe --rounds 3 --slo-ttft-p95 4   # gate a contest start
+  python3 test_server.py --probe --rounds 0 --interval 30 --jsonl probes.jsonl  # daemon
 
 This file intentionally uses only the Python standard library so it can run
 without extra dependencies.
@@ -167,14 +178,248 @@ def format_result(r: Dict[str, Any]) -> str:
         return f"[FAIL] {r['server']:20} {r['url']:30} ({r['elapsed']:.2f}s) -> {code} {r['body']}"
 
 
+CANARY_PROMPT = "Reply with the numbers from 1 to 10 separated by spaces."
+
+PROBE_METRICS = ("connect", "ttft", "tokens_per_sec", "total")
+
+
+async def _iter_body(reader: asyncio.StreamReader, headers: Dict[str, str]):
+    """Yield raw body bytes, decoding chunked transfer encoding if used."""
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b";")[0].strip() or b"0", 16)
+            if size == 0:
+                return
+            data = await reader.readexactly(size)
+            await reader.readexactly(2)  # CRLF after each chunk
+            yield data
+    else:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            yield data
+
+
+async def _probe_once(server: Dict[str, Any], model: str, prompt: str, num_predict: int) -> Dict[str, Any]:
+    """Send one canary request to a node's /stream and time it.
+
+    Uses a raw asyncio connection so the prober stays standard-library only.
+    """
+    body = json.dumps({
+        "model": model,
+        "prompt": prompt,
+        "stream": True,
+        "options": {"num_predict": num_predict, "temperature": 0},
+    }).encode("utf-8")
+    host, port = server["ip"], int(server["port"])
+    result: Dict[str, Any] = {
+        "status_code": None,
+        "connect": None,
+        "ttft": None,
+        "tokens": 0,
+        "tokens_per_sec": None,
+        "total": None,
+    }
+
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(host, port)
+    result["connect"] = time.perf_counter() - start
+    try:
+        writer.write(
+            f"POST /stream HTTP/1.1\r\nHost: {host}:{port}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode("ascii") + body
+        )
+        await writer.drain()
+
+        status_line = await reader.readline()
+        result["status_code"] = int(status_line.split()[1])
+        headers: Dict[str, str] = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            k, _, v = line.decode("latin-1").partition(":")
+            headers[k.strip().lower()] = v.strip()
+        if result["status_code"] != 200:
+            raise RuntimeError(f"HTTP {result['status_code']}")
+
+        first_token_at = None
+        final: Dict[str, Any] = {}
+        buf = b""
+        async for data in _iter_body(reader, headers):
+            buf += data
+            *lines, buf = buf.split(b"\n")
+            for line in lines:
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                if chunk.get("response"):
+                    result["tokens"] += 1
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        result["ttft"] = first_token_at - start
+                if chunk.get("done"):
+                    final = chunk
+        end = time.perf_counter()
+        result["total"] = end - start
+        if first_token_at is None:
+            raise RuntimeError("no tokens generated")
+
+        # prefer Ollama's own counters from the final chunk when present
+        if final.get("eval_count") and final.get("eval_duration"):
+            result["tokens"] = final["eval_count"]
+            result["tokens_per_sec"] = final["eval_count"] / (final["eval_duration"] / 1e9)
+        elif end > first_token_at:
+            result["tokens_per_sec"] = result["tokens"] / (end - first_token_at)
+        return result
+    finally:
+        writer.close()
+
+
+async def probe_server(server: Dict[str, Any], model: str, prompt: str, num_predict: int, timeout: float) -> Dict[str, Any]:
+    url = f"http://{server['ip']}:{server['port']}/stream"
+    out: Dict[str, Any] = {"type": "probe", "ts": time.time(), "server": server.get("name"), "url": url}
+    try:
+        out.update(await asyncio.wait_for(_probe_once(server, model, prompt, num_predict), timeout))
+        out["ok"] = True
+        out["error"] = None
+    except Exception as e:
+        out["ok"] = False
+        out["error"] = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+    return out
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    # nearest-rank percentile, good enough for small rolling windows
+    idx = max(0, math.ceil(q / 100.0 * len(sorted_values)) - 1)
+    return sorted_values[idx]
+
+
+class RollingStats:
+    """Last `window` probe results of one node."""
+
+    def __init__(self, window: int = 50):
+        self.results: deque = deque(maxlen=window)
+
+    def add(self, result: Dict[str, Any]):
+        self.results.append(result)
+
+    def summary(self) -> Dict[str, Any]:
+        n = len(self.results)
+        ok = [r for r in self.results if r["ok"]]
+        out: Dict[str, Any] = {"n": n, "success_rate": (len(ok) / n) if n else None}
+        for m in PROBE_METRICS:
+            values = sorted(r[m] for r in ok if r.get(m) is not None)
+            if values:
+                out[m] = {f"p{q}": round(_percentile(values, q), 4) for q in (50, 95, 99)}
+            else:
+                out[m] = None
+        return out
+
+
+def check_slo(summary: Dict[str, Any], slo: Dict[str, float]) -> List[str]:
+    """Return human readable SLO violations for one node's rolling summary (0 disables a check)."""
+    violations = []
+
+    def pct(metric: str, q: str) -> Optional[float]:
+        return (summary.get(metric) or {}).get(q)
+
+    if slo["success_rate"] and (summary["success_rate"] or 0) < slo["success_rate"]:
+        violations.append(f"success_rate {summary['success_rate'] or 0:.2f} < {slo['success_rate']}")
+    for metric, limit in (("connect", slo["connect_p95"]), ("ttft", slo["ttft_p95"]), ("total", slo["total_p95"])):
+        v = pct(metric, "p95")
+        if limit and v is not None and v > limit:
+            violations.append(f"{metric} p95 {v:.2f}s > {limit}s")
+    v = pct("tokens_per_sec", "p50")
+    if slo["tps_p50"] and v is not None and v < slo["tps_p50"]:
+        violations.append(f"tokens_per_sec p50 {v:.1f} < {slo['tps_p50']}")
+    return violations
+
+
+async def run_prober(args) -> int:
+    slo = {
+        "success_rate": args.slo_success,
+        "connect_p95": args.slo_connect_p95,
+        "ttft_p95": args.slo_ttft_p95,
+        "total_p95": args.slo_total_p95,
+        "tps_p50": args.slo_tps_p50,
+    }
+    stats = {s["name"]: RollingStats(args.window) for s in servers}
+    gate = asyncio.Semaphore(args.concurrency)
+    out = sys.stdout if args.jsonl == "-" else open(args.jsonl, "a", encoding="utf-8")
+
+    async def probe(s: Dict[str, Any]) -> Dict[str, Any]:
+        async with gate:
+            return await probe_server(s, args.model, args.prompt, args.num_predict, args.timeout)
+
+    def emit(record: Dict[str, Any]):
+        out.write(json.dumps(record) + "\n")
+        out.flush()
+
+    violating: List[str] = []
+    round_no = 0
+    try:
+        while True:
+            round_no += 1
+            results = await asyncio.gather(*(probe(s) for s in servers))
+            for r in results:
+                stats[r["server"]].add(r)
+                emit(r)
+
+            violating = []
+            for name, st in stats.items():
+                summary = st.summary()
+                violations = check_slo(summary, slo)
+                if violations:
+                    violating.append(name)
+                emit({"type": "summary", "ts": time.time(), "round": round_no, "server": name,
+                      "stats": summary, "violations": violations})
+            print(f"[probe] round {round_no}: {len(servers) - len(violating)} within SLO, "
+                  f"{len(violating)} violating", file=sys.stderr)
+
+            if args.rounds and round_no >= args.rounds:
+                break
+            await asyncio.sleep(args.interval)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 3 if violating else 0
+
+
 def main() -> int:
     p = argparse.ArgumentParser(description="Check /healthz for a list of servers")
-    p.add_argument("--timeout", type=float, default=5.0, help="HTTP timeout in seconds")
+    p.add_argument("--timeout", type=float, default=None,
+                   help="HTTP timeout in seconds (default 5, or 60 with --probe)")
     p.add_argument("--no-concurrent", dest="concurrent", action="store_false", help="Disable concurrent checks")
     p.add_argument("--json", action="store_true", help="Output results as JSON")
     p.add_argument("--fail-on-unhealthy", action="store_true", help="Exit with non-zero if any server is unhealthy")
+
+    g = p.add_argument_group("prober")
+    g.add_argument("--probe", action="store_true", help="Send a canary generation to each node's /stream instead of /healthz")
+    g.add_argument("--model", default="llama3.1", help="Model for the canary prompt")
+    g.add_argument("--prompt", default=CANARY_PROMPT, help="Canary prompt")
+    g.add_argument("--num-predict", type=int, default=32, help="Token cap for the canary generation")
+    g.add_argument("--rounds", type=int, default=1, help="Probe rounds to run (0 = run forever as a daemon)")
+    g.add_argument("--interval", type=float, default=30.0, help="Seconds between probe rounds")
+    g.add_argument("--window", type=int, default=50, help="Rolling window (probes per node) for percentiles")
+    g.add_argument("--concurrency", type=int, default=256, help="Max probes in flight")
+    g.add_argument("--jsonl", default="-", help="Append JSON lines here ('-' for stdout)")
+    g.add_argument("--slo-success", type=float, default=1.0, help="Min success rate per node")
+    g.add_argument("--slo-connect-p95", type=float, default=1.0, help="Max p95 connect time (s)")
+    g.add_argument("--slo-ttft-p95", type=float, default=5.0, help="Max p95 time to first token (s)")
+    g.add_argument("--slo-total-p95", type=float, default=30.0, help="Max p95 total time (s)")
+    g.add_argument("--slo-tps-p50", type=float, default=5.0, help="Min p50 tokens/sec")
     args = p.parse_args()
 
+    if args.timeout is None:
+        # a generation needs far longer than /healthz
+        args.timeout = 60.0 if args.probe else 5.0
+    if args.probe:
+        return asyncio.run(run_prober(args))
+
     results = run_checks(servers, timeout=args.timeout, concurrent=args.concurrent)
 
     if args.json:
@@ -0,0 +1,210 @@
+"""Lightweight per-request timing traces.
+
+Each request gets a `Trace` made of `Span`s (timed sections) and instant marks.
+Finished traces go into a fixed-size ring buffer; a fraction of them are sampled,
+but slow requests are always kept, and the slowest ones are tracked separately so
+they never get overwritten by a burst of fast traffic.
+
+Traces can be exported as Chrome trace-event JSON (open in chrome://tracing or
+https://ui.perfetto.dev). Both the load balancer and server.py record traces under
+the same request ID (sent in the X-Request-ID header) so their spans can be joined.
+"""
+
+import heapq, itertools, os, random, time, uuid
+from typing import Any, Dict, List, Optional
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "1024"))
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "5.0"))
+TRACE_SLOWEST_KEEP = int(os.getenv("TRACE_SLOWEST_KEEP", "64"))
+
+
+def new_request_id(incoming: Optional[str] = None) -> str:
+    """Reuse a sane client/upstream supplied ID, otherwise make a new one."""
+    if incoming and len(incoming) <= 64 and incoming.replace("-", "").isalnum():
+        return incoming
+    return uuid.uuid4().hex[:16]
+
+
+class Span:
+    __slots__ = ("name", "start", "end", "args")
+
+    def __init__(self, name: str, start: float, end: Optional[float] = None, args: Optional[dict] = None):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.args = args
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.perf_counter()
+        if exc_type is not None:
+            self.args = dict(self.args or {}, error=exc_type.__name__)
+        return False
+
+
+class Trace:
+    __slots__ = ("request_id", "endpoint", "client", "server", "status",
+                 "wall_start", "start", "end", "spans", "marks")
+
+    def __init__(self, request_id: str, endpoint: str, client: str, start: Optional[float] = None):
+        now = time.perf_counter()
+        self.start = start if start is not None else now
+        # wall clock of `start`, so traces from different processes line up
+        self.wall_start = time.time() - (now - self.start)
+        self.request_id = request_id
+        self.endpoint = endpoint
+        self.client = client
+        self.server: Optional[str] = None
+        self.status: Optional[str] = None
+        self.end: Optional[float] = None
+        self.spans: List[Span] = []
+        self.marks: List[Span] = []
+
+    def span(self, name: str, **args) -> Span:
+        """Time a section: `with trace.span("log_write"): ...`"""
+        s = Span(name, time.perf_counter(), None, args or None)
+        self.spans.append(s)
+        return s
+
+    def add_span(self, name: str, start: float, end: float, **args):
+        self.spans.append(Span(name, start, end, args or None))
+
+    def mark(self, name: str, **args):
+        """Record an instant event (TTFT, retry, release, ...)."""
+        t = time.perf_counter()
+        self.marks.append(Span(name, t, t, args or None))
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def to_dict(self) -> Dict[str, Any]:
+        def rel(t: Optional[float]) -> Optional[float]:
+            return None if t is None else round((t - self.start) * 1000, 3)
+
+        return {
+            'request_id': self.request_id,
+            'endpoint': self.endpoint,
+            'client': self.client,
+            'server': self.server,
+            'status': self.status,
+            'started_at': self.wall_start,
+            'duration_ms': round(self.duration * 1000, 3),
+            'spans': [{'name': s.name, 'start_ms': rel(s.start), 'end_ms': rel(s.end), 'args': s.args} for s in self.spans],
+            'marks': [{'name': m.name, 'at_ms': rel(m.start), 'args': m.args} for m in self.marks],
+        }
+
+
+class TraceBuffer:
+    """Ring buffer of finished traces plus a min-heap of the slowest ones."""
+
+    def __init__(self, process_name: str, size: int = TRACE_BUFFER_SIZE, sample_rate: float = TRACE_SAMPLE_RATE,
+                 slow_seconds: float = TRACE_SLOW_SECONDS, slowest_keep: int = TRACE_SLOWEST_KEEP):
+        self.process_name = process_name
+        self.size = size
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.slowest_keep = slowest_keep
+        self.ring: List[Optional[Trace]] = [None] * size
+        self.pos = 0
+        self.slowest: list = []  # heap of (duration, seq, trace)
+        self._seq = itertools.count()
+        self.finished = 0
+
+    def start(self, endpoint: str, client: str, request_id: Optional[str] = None,
+              start: Optional[float] = None) -> Trace:
+        return Trace(new_request_id(request_id), endpoint, client, start)
+
+    def finish(self, trace: Trace, status: str):
+        if trace.end is not None:
+            return
+        trace.end = time.perf_counter()
+        trace.status = status
+        self.finished += 1
+        d = trace.duration
+        # tail-based sampling: the decision is made once we know how slow it was
+        if d >= self.slow_seconds or random.random() < self.sample_rate:
+            self.ring[self.pos] = trace
+            self.pos = (self.pos + 1) % self.size
+        entry = (d, next(self._seq), trace)
+        if len(self.slowest) < self.slowest_keep:
+            heapq.heappush(self.slowest, entry)
+        elif d > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def recent(self, limit: int = 50) -> List[Trace]:
+        out = []
+        for i in range(1, self.size + 1):
+            t = self.ring[(self.pos - i) % self.size]
+            if t is None or len(out) >= limit:
+                break
+            out.append(t)
+        return out
+
+    def slowest_traces(self, limit: int = 50) -> List[Trace]:
+        return [t for _, _, t in heapq.nlargest(limit, self.slowest)]
+
+    def find(self, request_id: str) -> List[Trace]:
+        seen = {id(t): t for t in self.ring if t is not None and t.request_id == request_id}
+        seen.update({id(t): t for _, _, t in self.slowest if t.request_id == request_id})
+        return list(seen.values())
+
+    def debug_payload(self, limit: int = 50, fmt: str = "json", request_id: Optional[str] = None) -> Dict[str, Any]:
+        """Body for the /debug/requests endpoints."""
+        if request_id:
+            traces = self.find(request_id)
+            return chrome_trace(traces, self.process_name) if fmt == "chrome" else {'traces': [t.to_dict() for t in traces]}
+        recent = self.recent(limit)
+        slowest = self.slowest_traces(limit)
+        if fmt == "chrome":
+            merged = {id(t): t for t in recent + slowest}
+            return chrome_trace(list(merged.values()), self.process_name)
+        return {
+            'finished': self.finished,
+            'sample_rate': self.sample_rate,
+            'slow_seconds': self.slow_seconds,
+            'recent': [t.to_dict() for t in recent],
+            'slowest': [t.to_dict() for t in slowest],
+        }
+
+
+def chrome_trace(traces: List[Trace], process_name: str) -> Dict[str, Any]:
+    """Chrome trace-event format: one thread per request, spans as complete ("X") events."""
+    pid = os.getpid()
+    events: List[Dict[str, Any]] = [
+        {'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': process_name}},
+    ]
+    for tid, t in enumerate(traces, start=1):
+        def us(x: float) -> float:
+            return round((t.wall_start + (x - t.start)) * 1e6, 1)
+
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                       'args': {'name': f"{t.endpoint} {t.request_id}"}})
+        events.append({'name': t.endpoint, 'ph': 'X', 'pid': pid, 'tid': tid, 'ts': us(t.start),
+                       'dur': round(t.duration * 1e6, 1),
+                       'args': {'request_id': t.request_id, 'client': t.client, 'server': t.server, 'status': t.status}})
+        for s in t.spans:
+            end = s.end if s.end is not None else (t.end or s.start)
+            events.append({'name': s.name, 'ph': 'X', 'pid': pid, 'tid': tid, 'ts': us(s.start),
+                           'dur': round((end - s.start) * 1e6, 1), 'args': s.args or {}})
+        for m in t.marks:
+            events.append({'name': m.name, 'ph': 'i', 's': 't', 'pid': pid, 'tid': tid, 'ts': us(m.start),
+                           'args': m.args or {}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+class ArrivalTimeMiddleware:
+    """Pure ASGI middleware that stamps when a request arrived, before rate limiting runs."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] in ("http", "websocket"):
+            scope.setdefault("state", {})["arrived_at"] = time.perf_counter()
+        await self.app(scope, receive, send)